@@ -12,8 +12,21 @@ def register():
         aeat.TemplateTaxCodeRelation,
         aeat.TaxCodeMapping,
         aeat.TaxCodeRelation,
+        aeat.Period,
+        aeat.Move,
+        aeat.TaxLine,
+        aeat.TaxCode,
+        aeat.Cron,
+        aeat.ReportLine,
+        aeat.ExportReportResult,
+        aeat.ImportReportStart,
+        aeat.ImportReportResult,
         module='aeat_303', type_='model')
     Pool.register(
         aeat.CreateChart,
         aeat.UpdateChart,
+        aeat.ReportLineOpenTaxLines,
+        aeat.ReportLineOpenMoveLines,
+        aeat.ExportReport,
+        aeat.ImportReport,
         module='aeat_303', type_='wizard')
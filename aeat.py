@@ -1,25 +1,49 @@
 # -*- coding: utf-8 -*-
 from decimal import Decimal
 import datetime
+import io
+import json
 import calendar
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+import hashlib
+from itertools import islice
+import logging
+import multiprocessing
+import os
 import unicodedata
 import sys
+import tempfile
+import time
+import zipfile
 
 from retrofix import aeat303
 from retrofix.record import Record, write as retrofix_write
 from trytond.model import Workflow, ModelSQL, ModelView, fields, Unique
+from trytond.wizard import (Wizard, StateView, StateTransition, StateAction,
+    Button)
 from trytond.pool import Pool, PoolMeta
-from trytond.pyson import Eval, Bool
+from trytond.pyson import Eval, Bool, PYSONEncoder
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 from trytond.transaction import Transaction
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.tools import reduce_ids, grouped_slice
 from trytond import backend
-from sql import Literal
+from trytond.filestore import filestore
+from sql import Column, Literal, Null
+from sql.aggregate import Count, Sum
+from sql.conditionals import Case, Coalesce
 
 
 __all__ = ['Report', 'TemplateTaxCodeMapping', 'TemplateTaxCodeRelation',
     'TaxCodeMapping', 'TaxCodeRelation', 'CreateChart',
-    'UpdateChart']
+    'UpdateChart', 'Period', 'Move', 'TaxLine', 'TaxCode', 'Cron',
+    'ExportReportResult', 'ReportLine', 'ReportLineOpenTaxLines',
+    'ReportLineOpenMoveLines', 'ExportReport', 'ImportReportStart',
+    'ImportReportResult', 'ImportReport']
 
 _STATES = {
     'readonly': Eval('state') == 'done',
@@ -29,8 +53,44 @@ _DEPENDS = ['state']
 
 _Z = Decimal("0.0")
 
+logger = logging.getLogger(__name__)
 
-def remove_accents(unicode_string):
+
+class AccentsTable(dict):
+    '''
+    Translation table for str.translate that removes the accents and, if
+    upper is set, converts to uppercase.
+    The Latin characters are computed at creation and the others on their
+    first use.
+    '''
+
+    def __init__(self, upper=False):
+        super(AccentsTable, self).__init__()
+        self.upper = upper
+        for code in range(0x250):
+            self[code]
+
+    def __missing__(self, code):
+        char = ''.join(c for c in unicodedata.normalize('NFD', chr(code))
+            if unicodedata.category(c) != 'Mn')
+        char = unicodedata.normalize('NFC', char)
+        if self.upper:
+            char = char.upper()
+        self[code] = char
+        return char
+
+
+_ACCENTS_TABLE = AccentsTable()
+_ACCENTS_UPPER_TABLE = AccentsTable(upper=True)
+
+
+def remove_accents(unicode_string, upper=False):
+    '''
+    Return the string without accents and in uppercase if upper is set.
+    A list of strings can be passed to convert them all at once.
+    '''
+    if isinstance(unicode_string, (list, tuple)):
+        return [remove_accents(s, upper=upper) for s in unicode_string]
     str_ = str if sys.version_info < (3, 0) else bytes
     unicode_ = str if sys.version_info < (3, 0) else str
     if isinstance(unicode_string, str_):
@@ -46,13 +106,112 @@ def remove_accents(unicode_string):
     if not isinstance(unicode_string, unicode_):
         return unicode_string
 
-    unicode_string_nfd = ''.join(
-        (c for c in unicodedata.normalize('NFD', unicode_string)
-            if (unicodedata.category(c) != 'Mn'
-                or c in ('\\u0327', '\\u0303'))  # Avoids normalize ç and ñ
-            ))
-    # It converts nfd to nfc to allow unicode.decode()
-    return unicodedata.normalize('NFC', unicode_string_nfd)
+    return unicode_string.translate(
+        _ACCENTS_UPPER_TABLE if upper else _ACCENTS_TABLE)
+
+
+def iter_files(source):
+    '''
+    Yield the name and the content of each file of source.
+    source is the path of a directory, a ZIP archive or a single file, or a
+    file object of a ZIP archive. The files are read one at a time.
+    '''
+    if isinstance(source, str) and os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                with open(path, 'rb') as fp:
+                    yield path, fp.read()
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for info in archive.infolist():
+                if not info.is_dir():
+                    yield info.filename, archive.read(info)
+    else:
+        with open(source, 'rb') as fp:
+            yield source, fp.read()
+
+
+def extract_record(line, layout):
+    '''
+    Return the record of layout extracted from line.
+    The blank columns that the field does not accept, like those of numbers
+    and dates left empty by create_file, are extracted as no value.
+    '''
+    record = Record(layout)
+    for start, size, name, _ in layout:
+        value = line[start - 1:start - 1 + size]
+        try:
+            record.set_from_file(name, value)
+        except Exception:
+            if value.strip():
+                raise
+    return record
+
+
+def queued(func):
+    '''
+    Decorator to run the method of the reports from the queue when it is
+    activated in the aeat_303 section of the configuration.
+    '''
+    @wraps(func)
+    def wrapper(cls, reports):
+        context = Transaction().context
+        if context.get('_aeat_303_queued'):
+            return cls.run_queued(func, reports)
+        if (context.get('_aeat_303_no_queue')
+                or not config.getboolean('aeat_303', 'queue', default=False)):
+            return func(cls, reports)
+        cls.push_queue(func.__name__, reports)
+    return wrapper
+
+
+class Timer(object):
+    "Record the duration in seconds of the phases of an operation"
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def __call__(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = round(self.timings.get(phase, 0)
+                + time.perf_counter() - start, 6)
+
+
+def _calculate_init(settings):
+    "Initialize a process to calculate reports with the configuration"
+    for section, options in settings.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for option, value in options.items():
+            config.set(section, option, value)
+
+
+def _calculate_company(database_name, user, context, report_ids):
+    '''
+    Calculate the reports in their own transaction and return the error
+    message if it fails.
+    The reports are calculated by the process even if the queue is activated.
+    '''
+    pool = Pool(database_name)
+    if database_name not in Pool.database_list():
+        with Transaction().start(database_name, 0, readonly=True):
+            pool.init()
+    context = dict(context, _aeat_303_no_queue=True)
+    try:
+        with Transaction(new=True).start(
+                database_name, user, context=context):
+            Report = pool.get('aeat.303.report')
+            Report.calculate(Report.browse(report_ids))
+    except Exception as exception:
+        logger.warning('calculate of AEAT 303 reports %s failed',
+            report_ids, exc_info=True)
+        return getattr(exception, 'message', str(exception))
 
 
 class TemplateTaxCodeRelation(ModelSQL):
@@ -101,7 +260,38 @@ class TemplateTaxCodeMapping(ModelSQL):
     def default_type_():
         return 'code'
 
-    def _get_mapping_value(self, mapping=None):
+    @classmethod
+    def get_tax_codes(cls, templates, company=None):
+        '''
+        Return a dictionary of template id to the set of ids of the tax codes
+        created from its tax code templates.
+        The tax codes of all the templates are searched at once and only
+        those of company if it is set.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+
+        code2templates = defaultdict(set)
+        for template in templates:
+            for code in template.code:
+                code2templates[code.id].add(template.id)
+        result = {t.id: set() for t in templates}
+        domain = []
+        if company is not None:
+            domain.append(('company', '=', int(company)))
+        for sub_ids in grouped_slice(list(code2templates)):
+            for tax_code in TaxCode.search(
+                    domain + [('template', 'in', list(sub_ids))]):
+                for template_id in code2templates[tax_code.template.id]:
+                    result[template_id].add(tax_code.id)
+        return result
+
+    def _get_mapping_value(self, mapping=None, codes=None):
+        '''
+        Return the values to create or update mapping from the template.
+        codes is the set of tax code ids resolved by get_tax_codes, they are
+        searched if it is None.
+        '''
         pool = Pool()
         TaxCode = pool.get('account.tax.code')
 
@@ -117,7 +307,9 @@ class TemplateTaxCodeMapping(ModelSQL):
         new_ids = set()
         if mapping and len(mapping.code) > 0:
             old_ids = set([c.id for c in mapping.code])
-        if len(self.code) > 0:
+        if codes is not None:
+            new_ids = set(codes)
+        elif len(self.code) > 0:
             new_ids = set([c.id for c in TaxCode.search([
                             ('template', 'in', [c.id for c in self.code])
                             ])])
@@ -144,31 +336,9 @@ class UpdateChart(metaclass=PoolMeta):
 
     def transition_update(self):
         pool = Pool()
-        MappingTemplate = pool.get('aeat.303.template.mapping')
         Mapping = pool.get('aeat.303.mapping')
         ret = super(UpdateChart, self).transition_update()
-        # Update current values
-        ids = []
-        company = self.start.account.company.id
-        for mapping in Mapping.search([
-                    ('company', 'in', [company, None]),
-                    ]):
-            if not mapping.template:
-                continue
-            vals = mapping.template._get_mapping_value(mapping=mapping)
-            if vals:
-                Mapping.write([mapping], vals)
-            ids.append(mapping.template.id)
-
-        # Create new one's
-        to_create = []
-        for template in MappingTemplate.search([('id', 'not in', ids)]):
-            vals = template._get_mapping_value()
-            if vals:
-                vals['company'] = company
-                to_create.append(vals)
-        if to_create:
-            Mapping.create(to_create)
+        Mapping.update_from_templates([self.start.account.company])
         return ret
 
 
@@ -177,23 +347,103 @@ class CreateChart(metaclass=PoolMeta):
 
     def transition_create_account(self):
         pool = Pool()
-        MappingTemplate = pool.get('aeat.303.template.mapping')
         Mapping = pool.get('aeat.303.mapping')
 
-        company = self.account.company.id
-
         ret = super(CreateChart, self).transition_create_account()
-        to_create = []
-        for template in MappingTemplate.search([]):
-            vals = template._get_mapping_value()
-            if vals:
-                vals['company'] = company
-                to_create.append(vals)
-
-        Mapping.create(to_create)
+        Mapping.create_from_templates([self.account.company])
         return ret
 
 
+class Period(metaclass=PoolMeta):
+    __name__ = 'account.period'
+
+    @classmethod
+    def create(cls, vlist):
+        Report = Pool().get('aeat.303.report')
+        periods = super(Period, cls).create(vlist)
+        Report._period_ids_cache.clear()
+        return periods
+
+    @classmethod
+    def write(cls, *args):
+        Report = Pool().get('aeat.303.report')
+        super(Period, cls).write(*args)
+        Report._period_ids_cache.clear()
+
+    @classmethod
+    def delete(cls, periods):
+        Report = Pool().get('aeat.303.report')
+        super(Period, cls).delete(periods)
+        Report._period_ids_cache.clear()
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'account.move'
+
+    @classmethod
+    def write(cls, *args):
+        Report = Pool().get('aeat.303.report')
+        # Only the moves posted before are in the snapshots
+        posted = [m for m in sum(args[0:None:2], []) if m.state == 'posted']
+        super(Move, cls).write(*args)
+        Report.clear_snapshots(posted)
+
+
+class TaxLine(metaclass=PoolMeta):
+    __name__ = 'account.tax.line'
+
+    @classmethod
+    def write(cls, *args):
+        Report = Pool().get('aeat.303.report')
+        super(TaxLine, cls).write(*args)
+        Report.clear_snapshots(
+            [l.move_line.move for l in sum(args[0:None:2], [])])
+
+    @classmethod
+    def delete(cls, lines):
+        Report = Pool().get('aeat.303.report')
+        moves = [l.move_line.move for l in lines]
+        super(TaxLine, cls).delete(lines)
+        Report.clear_snapshots(moves)
+
+
+class TaxCode(metaclass=PoolMeta):
+    __name__ = 'account.tax.code'
+
+    @classmethod
+    def create(cls, vlist):
+        Report = Pool().get('aeat.303.report')
+        codes = super(TaxCode, cls).create(vlist)
+        Report._tax_code_closure_cache.clear()
+        return codes
+
+    @classmethod
+    def write(cls, *args):
+        Report = Pool().get('aeat.303.report')
+        super(TaxCode, cls).write(*args)
+        Report._tax_code_closure_cache.clear()
+
+    @classmethod
+    def delete(cls, codes):
+        Report = Pool().get('aeat.303.report')
+        super(TaxCode, cls).delete(codes)
+        Report._tax_code_closure_cache.clear()
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+                ('aeat.303.report|calculate_draft',
+                    "Calculate AEAT 303 Reports"),
+                ('aeat.303.mapping|check_integrity_cron',
+                    "Check AEAT 303 Mappings Integrity"),
+                ])
+
+
 class TaxCodeRelation(ModelSQL):
     '''
     AEAT 303 TaxCode Mapping Codes Relation
@@ -205,6 +455,37 @@ class TaxCodeRelation(ModelSQL):
     code = fields.Many2One('account.tax.code', 'Tax Code', required=True,
         select=True)
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(TaxCodeRelation, cls).__register__(module_name)
+        table = backend.TableHandler(cls, module_name)
+        table.index_action(['mapping', 'code'], 'add')
+
+    @classmethod
+    def create(cls, vlist):
+        Mapping = Pool().get('aeat.303.mapping')
+        relations = super(TaxCodeRelation, cls).create(vlist)
+        Mapping._compiled_cache.clear()
+        return relations
+
+    @classmethod
+    def write(cls, *args):
+        Mapping = Pool().get('aeat.303.mapping')
+        super(TaxCodeRelation, cls).write(*args)
+        Mapping._compiled_cache.clear()
+
+    @classmethod
+    def delete(cls, relations):
+        Mapping = Pool().get('aeat.303.mapping')
+        super(TaxCodeRelation, cls).delete(relations)
+        Mapping._compiled_cache.clear()
+
+    @classmethod
+    def validate(cls, relations):
+        Mapping = Pool().get('aeat.303.mapping')
+        super(TaxCodeRelation, cls).validate(relations)
+        Mapping.check_mappings_integrity({r.mapping for r in relations})
+
 
 class TaxCodeMapping(ModelSQL, ModelView):
     '''
@@ -230,6 +511,7 @@ class TaxCodeMapping(ModelSQL, ModelView):
             },
         depends=['type_'])
     template = fields.Many2One('aeat.303.template.mapping', 'Template')
+    _compiled_cache = Cache('aeat.303.mapping.compiled', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -240,6 +522,12 @@ class TaxCodeMapping(ModelSQL, ModelView):
                 'Field must be unique.')
             ]
 
+    @classmethod
+    def __register__(cls, module_name):
+        super(TaxCodeMapping, cls).__register__(module_name)
+        table = backend.TableHandler(cls, module_name)
+        table.index_action(['company', 'type_'], 'add')
+
     @staticmethod
     def default_type_():
         return 'code'
@@ -248,6 +536,375 @@ class TaxCodeMapping(ModelSQL, ModelView):
     def default_company():
         return Transaction().context.get('company') or None
 
+    @classmethod
+    def create(cls, vlist):
+        mappings = super(TaxCodeMapping, cls).create(vlist)
+        cls._compiled_cache.clear()
+        return mappings
+
+    @classmethod
+    def write(cls, *args):
+        super(TaxCodeMapping, cls).write(*args)
+        cls._compiled_cache.clear()
+
+    @classmethod
+    def delete(cls, mappings):
+        super(TaxCodeMapping, cls).delete(mappings)
+        cls._compiled_cache.clear()
+
+    @classmethod
+    def validate(cls, mappings):
+        super(TaxCodeMapping, cls).validate(mappings)
+        cls.check_mappings_integrity(mappings)
+
+    @classmethod
+    def create_from_templates(cls, companies):
+        '''
+        Create the mappings of the templates for the companies and return
+        them.
+        The fields already mapped by a company are skipped and the mappings
+        of all the companies are created at once.
+        '''
+        pool = Pool()
+        MappingTemplate = pool.get('aeat.303.template.mapping')
+
+        templates = MappingTemplate.search([])
+        mapped = defaultdict(set)
+        for mapping in cls.search([
+                    ('company', 'in', [int(c) for c in companies]),
+                    ]):
+            mapped[mapping.company.id].add(mapping.aeat303_field.id)
+
+        to_create = []
+        for company in companies:
+            company = int(company)
+            codes = MappingTemplate.get_tax_codes(templates, company)
+            for template in templates:
+                if template.aeat303_field.id in mapped[company]:
+                    continue
+                vals = template._get_mapping_value(codes=codes[template.id])
+                if vals:
+                    vals['company'] = company
+                    to_create.append(vals)
+        if not to_create:
+            return []
+        # The relations of all the mappings are created at once
+        return cls.create(to_create)
+
+    @classmethod
+    def get_template_changes(cls, companies):
+        '''
+        Return the changes to follow the templates of the mappings of the
+        companies and of those without company as a tuple with the list of
+        mappings and their values to write and the list of values to create.
+        '''
+        pool = Pool()
+        MappingTemplate = pool.get('aeat.303.template.mapping')
+
+        company_ids = [int(c) for c in companies]
+        templates = MappingTemplate.search([])
+        mappings = [m for m in cls.search([
+                    ('company', 'in', company_ids + [None]),
+                    ]) if m.template]
+        # The tax codes of the templates are resolved at once by company, the
+        # mappings without company keep the codes of all the companies
+        codes = {None: MappingTemplate.get_tax_codes(
+                list({m.template for m in mappings if not m.company}))}
+        for company_id in company_ids:
+            codes[company_id] = MappingTemplate.get_tax_codes(
+                templates, company_id)
+
+        to_write = []
+        mapped = defaultdict(set)
+        for mapping in mappings:
+            company_id = mapping.company.id if mapping.company else None
+            mapped[company_id].add(mapping.template.id)
+            vals = mapping.template._get_mapping_value(mapping=mapping,
+                codes=codes[company_id][mapping.template.id])
+            if vals.get('code') == []:
+                del vals['code']
+            if vals:
+                to_write.append((mapping, vals))
+
+        to_create = []
+        for company_id in company_ids:
+            for template in templates:
+                if (template.id in mapped[company_id]
+                        or template.id in mapped[None]):
+                    continue
+                vals = template._get_mapping_value(
+                    codes=codes[company_id][template.id])
+                if vals:
+                    vals['company'] = company_id
+                    to_create.append(vals)
+        return to_write, to_create
+
+    @classmethod
+    def update_from_templates(cls, companies):
+        '''
+        Update the mappings of the companies and of those without company
+        from the templates and create the missing ones.
+        '''
+        pool = Pool()
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+
+        to_write, to_create = cls.get_template_changes(companies)
+        # The differences of codes are applied with a single creation and
+        # deletion of relations
+        args = []
+        to_add, to_remove = [], []
+        for mapping, vals in to_write:
+            vals = vals.copy()
+            for action, code_ids in vals.pop('code', []):
+                pairs = to_add if action == 'add' else to_remove
+                pairs.extend((mapping.id, c) for c in code_ids)
+            if vals:
+                args.extend([[mapping], vals])
+        # The relations are updated first so the mappings are validated
+        # with their new codes
+        if to_remove:
+            relations = []
+            for sub_pairs in grouped_slice(to_remove):
+                sub_pairs = list(sub_pairs)
+                relations.extend(Relation.search([
+                            ('mapping', 'in', [m for m, _ in sub_pairs]),
+                            ('code', 'in', [c for _, c in sub_pairs]),
+                            ]))
+            to_remove = set(to_remove)
+            Relation.delete([r for r in relations
+                    if (r.mapping.id, r.code.id) in to_remove])
+        if to_add:
+            Relation.create([{
+                        'mapping': m,
+                        'code': c,
+                        } for m, c in to_add])
+        if args:
+            cls.write(*args)
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def diff_templates(cls, companies):
+        '''
+        Return the changes that update_from_templates would apply without
+        applying them.
+        The result is a dictionary of company id, None for the mappings
+        without company, to a dictionary of field name to a dictionary with:
+            - create: if the mapping is created
+            - add: the sorted ids of the tax codes to add
+            - remove: the sorted ids of the tax codes to remove
+            - values: the sorted names of the other fields to write
+        Only the fields with changes are included.
+        '''
+        pool = Pool()
+        Field = pool.get('ir.model.field')
+
+        to_write, to_create = cls.get_template_changes(companies)
+        field_names = {f.id: f.name for f in Field.browse(
+                list({v['aeat303_field'] for v in to_create}))}
+
+        def summary(vals, create):
+            codes = {'add': [], 'remove': []}
+            for action, code_ids in vals.get('code', []):
+                codes[action].extend(code_ids)
+            return {
+                'create': create,
+                'add': sorted(codes['add']),
+                'remove': sorted(codes['remove']),
+                'values': [] if create else sorted(
+                    set(vals) - {'code', 'company'}),
+                }
+
+        result = defaultdict(dict)
+        for mapping, vals in to_write:
+            company_id = mapping.company.id if mapping.company else None
+            result[company_id][mapping.aeat303_field.name] = summary(
+                vals, False)
+        for vals in to_create:
+            result[vals['company']][field_names[vals['aeat303_field']]] = (
+                summary(vals, True))
+        return dict(result)
+
+    @classmethod
+    def get_integrity_problems(cls, companies=None):
+        '''
+        Return the integrity problems of the mappings of the companies, and
+        those without company, or of all the mappings if companies is None.
+        The problems are a list of tuples with the kind, the company id, the
+        mapping ids and the tax code ids involved. The kinds are:
+            - duplicated: a tax code mapped to many fields by the mappings
+              used for the company as get_compiled does
+            - empty: a code mapping without tax codes
+            - company: a mapping to tax codes of another company
+        '''
+        pool = Pool()
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+        TaxCode = pool.get('account.tax.code')
+        cursor = Transaction().connection.cursor()
+        mapping = cls.__table__()
+        relation = Relation.__table__()
+        tax_code = TaxCode.__table__()
+
+        if companies is None:
+            where = Literal(True)
+        else:
+            companies = [int(c) for c in companies]
+            where = (reduce_ids(mapping.company, companies)
+                | (mapping.company == Null))
+        problems = []
+
+        cursor.execute(*mapping.select(
+                mapping.id, mapping.company, mapping.aeat303_field,
+                where=where,
+                order_by=mapping.id))
+        mappings = cursor.fetchall()
+        mapping2codes = defaultdict(list)
+        for sub_ids in grouped_slice([m[0] for m in mappings]):
+            cursor.execute(*relation.select(relation.mapping, relation.code,
+                    where=reduce_ids(relation.mapping, sub_ids),
+                    order_by=relation.code))
+            for mapping_id, code in cursor:
+                mapping2codes[mapping_id].append(code)
+        if companies is None:
+            # The mappings without company are checked alone for the
+            # companies that have no mapping
+            companies = [None] + sorted(
+                {m[1] for m in mappings if m[1] is not None})
+        reported = set()
+        for company in companies:
+            # The mappings of the company replace those without company
+            # field by field
+            field2mapping = {}
+            for mapping_id, mapping_company, field in mappings:
+                if mapping_company is None:
+                    field2mapping.setdefault(field, mapping_id)
+                elif mapping_company == company:
+                    field2mapping[field] = mapping_id
+            code2mappings = defaultdict(set)
+            for mapping_id in field2mapping.values():
+                for code in mapping2codes[mapping_id]:
+                    code2mappings[code].add(mapping_id)
+            for code, mapping_ids in sorted(code2mappings.items()):
+                key = (code, tuple(sorted(mapping_ids)))
+                if len(mapping_ids) > 1 and key not in reported:
+                    reported.add(key)
+                    problems.append(
+                        ('duplicated', company, list(key[1]), [code]))
+
+        cursor.execute(*mapping.join(relation, 'LEFT',
+                condition=relation.mapping == mapping.id
+                ).select(mapping.company, mapping.id,
+                where=where & (mapping.type_ == 'code')
+                & (relation.id == Null),
+                order_by=mapping.id))
+        for company, mapping_id in cursor:
+            problems.append(('empty', company, [mapping_id], []))
+
+        cursor.execute(*relation.join(mapping,
+                condition=relation.mapping == mapping.id
+                ).join(tax_code,
+                condition=relation.code == tax_code.id
+                ).select(mapping.company, mapping.id, relation.code,
+                where=where & (mapping.company != Null)
+                & (tax_code.company != mapping.company),
+                order_by=[mapping.id, relation.code]))
+        for company, mapping_id, code in cursor:
+            problems.append(('company', company, [mapping_id], [code]))
+        return problems
+
+    @classmethod
+    def get_integrity_messages(cls, companies=None, mappings=None):
+        '''
+        Return the messages of the integrity problems of the mappings.
+        If mappings is given, only the problems that involve them are kept.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+
+        if mappings is not None:
+            ids = {int(m) for m in mappings}
+        messages = []
+        for kind, company, mapping_ids, code_ids in (
+                cls.get_integrity_problems(companies)):
+            if mappings is not None and not ids.intersection(mapping_ids):
+                continue
+            fields_ = ', '.join(
+                m.aeat303_field.name for m in cls.browse(mapping_ids))
+            codes = ', '.join(c.rec_name for c in TaxCode.browse(code_ids))
+            messages.append(gettext('aeat_303.msg_mapping_%s' % kind,
+                    fields=fields_, codes=codes))
+        return messages
+
+    @classmethod
+    def check_integrity(cls, companies=None, mappings=None):
+        '''
+        Raise an error if the mappings of the companies have problems.
+        If mappings is given, only the problems that involve them are raised.
+        '''
+        messages = cls.get_integrity_messages(companies, mappings)
+        if messages:
+            raise UserError(gettext('aeat_303.msg_mapping_integrity'),
+                '\n'.join(messages))
+
+    @classmethod
+    def check_mappings_integrity(cls, mappings):
+        "Raise an error if the mappings are involved in integrity problems"
+        if any(m.company is None for m in mappings):
+            # The mappings without company are used by all the companies
+            companies = None
+        else:
+            companies = {m.company.id for m in mappings}
+        with Transaction().set_context(_check_access=False):
+            cls.check_integrity(companies, mappings)
+
+    @classmethod
+    def check_integrity_cron(cls):
+        "Report the integrity problems of the mappings of all the companies"
+        with Transaction().set_context(_check_access=False):
+            messages = cls.get_integrity_messages()
+        for message in messages:
+            logger.warning('AEAT 303 mapping integrity: %s', message)
+
+    @classmethod
+    def get_compiled(cls, company):
+        '''
+        Return the compiled mappings of the company as a tuple with a
+        dictionary of tax code id to field name and a dictionary of field
+        name to fixed number.
+        The mappings without company are used for the fields that the company
+        does not map.
+        '''
+        company = int(company) if company is not None else None
+        compiled = cls._compiled_cache.get(company)
+        if compiled is not None:
+            return compiled
+
+        # The result is cached by company so it must not depend on the user
+        with Transaction().set_context(_check_access=False):
+            mappings = cls.search([
+                    ('company', 'in', [company, None]),
+                    ], order=[('id', 'ASC')])
+        field2mapping = {}
+        for mapping in mappings:
+            field = mapping.aeat303_field.name
+            if mapping.company or field not in field2mapping:
+                field2mapping[field] = mapping
+
+        codes = {}
+        fixed = {}
+        for mapping in mappings:
+            field = mapping.aeat303_field.name
+            if field2mapping[field] != mapping:
+                continue
+            if mapping.type_ == 'code':
+                for code in mapping.code:
+                    codes[code.id] = field
+            elif mapping.type_ == 'numeric':
+                fixed[field] = mapping.number
+        compiled = (codes, fixed)
+        cls._compiled_cache.set(company, compiled)
+        return compiled
+
 
 class Report(Workflow, ModelSQL, ModelView):
     '''
@@ -347,8 +1004,8 @@ class Report(Workflow, ModelSQL, ModelView):
         'Other Passive Subject Adquisitions Base', digits=(16, 2))
     other_passive_subject_tax = fields.Numeric(
         'Other Passive Subject Adquisitions Tax', digits=(16, 2))
-    accrued_total_tax = fields.Function(fields.Numeric('Accrued Total Tax',
-            digits=(16, 2)), 'get_accrued_total_tax')
+    accrued_total_tax = fields.Numeric('Accrued Total Tax', digits=(16, 2),
+        readonly=True, select=True)
     deductible_current_domestic_operations_base = fields.Numeric(
         'Deductible Current Domestic Operations Base', digits=(16, 2))
     deductible_current_domestic_operations_tax = fields.Numeric(
@@ -383,20 +1040,20 @@ class Report(Workflow, ModelSQL, ModelView):
         'Deductible Investment Regularization', digits=(16, 2))
     deductible_pro_rata_regularization = fields.Numeric(
         'Deductible Pro Rata Regularization', digits=(16, 2))
-    deductible_total = fields.Function(fields.Numeric('Deductible Total',
-            digits=(16, 2)), 'get_deductible_total')
+    deductible_total = fields.Numeric('Deductible Total', digits=(16, 2),
+        readonly=True, select=True)
     result_tax_regularitzation = fields.Numeric(
         'Tax Regularization art. 80.cinco.50a LIVA', digits=(16, 2),
         help="Only fill if you have done the 952 model. To Fill with the tax "
         "to recover.")
     general_regime_result = fields.Function(fields.Numeric(
             'General Regime Result',
-            digits=(16, 2)), 'get_general_regime_result')
+            digits=(16, 2)), 'get_totals')
     state_administration_percent = fields.Numeric(
         'State Administration Percent', digits=(16, 2))
     state_administration_amount = fields.Function(
         fields.Numeric('State Administration Amount', digits=(16, 2)),
-        'get_state_administration_amount')
+        'get_totals')
     previous_report = fields.Many2One('aeat.303.report', 'Previous Report',
         states={
             'readonly': Eval('state') == 'done',
@@ -410,24 +1067,24 @@ class Report(Workflow, ModelSQL, ModelView):
         'Previous Period Amount To Compensate', digits=(16, 2))
     result_previous_period_amount_to_compensate = fields.Function(
         fields.Numeric('Result Previous Period Amount To Compensate',
-            digits=(16, 2)), 'get_result_previous_period_amount_to_compensate')
+            digits=(16, 2)), 'get_totals')
     intracommunity_deliveries = fields.Numeric(
         'Intracommunity Deliveries', digits=(16, 2))
     exports = fields.Numeric('Exports', digits=(16, 2))
     not_subject_or_reverse_charge = fields.Numeric(
         'Not Subject Or Reverse Charge', digits=(16, 2))
     sum_results = fields.Function(fields.Numeric(
-            'Sum of Results', digits=(16, 2)), 'get_sum_results')
+            'Sum of Results', digits=(16, 2)), 'get_totals')
     aduana_tax_pending = fields.Numeric(
         'Aduana Tax Pending', digits=(16, 2),
         help="Import VAT paid by Aduana pending entry")
     joint_taxation_state_provincial_councils = fields.Numeric(
         'Joint Taxation State Provincial Councils', digits=(16, 2))
-    result = fields.Function(fields.Numeric('Result', digits=(16, 2)),
-        'get_result')
+    result = fields.Numeric('Result', digits=(16, 2), readonly=True,
+        select=True)
     to_deduce = fields.Numeric('To Deduce', digits=(16, 2))
-    liquidation_result = fields.Function(fields.Numeric('Liquidation Result',
-        digits=(16, 2)), 'get_liquidation_result')
+    liquidation_result = fields.Numeric('Liquidation Result', digits=(16, 2),
+        readonly=True, select=True)
     amount_to_compensate = fields.Numeric('Amount To Compensate',
         digits=(16, 2))
     recc_deliveries_base = fields.Numeric(
@@ -466,7 +1123,7 @@ class Report(Workflow, ModelSQL, ModelView):
     without_activity = fields.Boolean('Without Activity')
     company_party = fields.Function(fields.Many2One('party.party',
             'Company Party'),
-        'on_change_with_company_party')
+        'get_company_party')
     bank_account = fields.Many2One('bank.account', 'Bank Account',
         domain=[
             ('owners', '=', Eval('company_party')),
@@ -522,17 +1179,74 @@ class Report(Workflow, ModelSQL, ModelView):
             ], 'Auto Bankruptcy Declaration', required=True)
     auto_bankruptcy_date = fields.Date('Auto Bankruptcy Date')
     calculation_date = fields.DateTime('Calculation Date', readonly=True)
+    timings = fields.Dict(None, 'Timings', readonly=True)
+    snapshot = fields.Dict(None, 'Snapshot', readonly=True)
+    snapshot_date = fields.DateTime('Snapshot Date', readonly=True)
     state = fields.Selection([
             ('draft', 'Draft'),
             ('calculated', 'Calculated'),
             ('done', 'Done'),
             ('cancelled', 'Cancelled')
             ], 'State', readonly=True)
-    file_ = fields.Binary('File', filename='filename', states={
+    file_ = fields.Binary('File', filename='filename', file_id='file_id',
+        states={
             'invisible': Eval('state') != 'done',
             }, readonly=True)
+    file_id = fields.Char('File ID', readonly=True)
+    file_hash = fields.Char('File Hash', readonly=True)
+    file_values = fields.Dict(None, 'File Values', readonly=True)
     filename = fields.Function(fields.Char("File Name"),
         'get_filename')
+    queue_state = fields.Selection([
+            (None, ''),
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('failed', 'Failed'),
+            ], 'Queue State', readonly=True)
+    queue_error = fields.Text('Queue Error', readonly=True,
+        states={
+            'invisible': Eval('queue_state') != 'failed',
+            }, depends=['queue_state'])
+    lines = fields.One2Many('aeat.303.report.line', 'report', 'Lines',
+        readonly=True)
+    # Amounts summed by the totals
+    _accrued_tax_fields = [
+        'accrued_vat_tax_1', 'accrued_vat_tax_2', 'accrued_vat_tax_3',
+        'intracommunity_adquisitions_tax', 'other_passive_subject_tax',
+        'accrued_vat_tax_modification', 'accrued_re_tax_1',
+        'accrued_re_tax_2', 'accrued_re_tax_3', 'accrued_re_tax_modification',
+        ]
+    _deductible_fields = [
+        'deductible_current_domestic_operations_tax',
+        'deductible_investment_domestic_operations_tax',
+        'deductible_current_import_operations_tax',
+        'deductible_investment_import_operations_tax',
+        'deductible_current_intracommunity_operations_tax',
+        'deductible_investment_intracommunity_operations_tax',
+        'deductible_regularization_tax', 'deductible_compensations',
+        'deductible_investment_regularization',
+        'deductible_pro_rata_regularization',
+        ]
+    # Amounts the totals are computed from
+    _total_amount_fields = _accrued_tax_fields + _deductible_fields + [
+        'state_administration_percent', 'result_tax_regularitzation',
+        'previous_period_pending_amount_to_compensate',
+        'previous_period_amount_to_compensate', 'aduana_tax_pending',
+        'joint_taxation_state_provincial_councils', 'to_deduce',
+        ]
+    # Totals stored to be searched and sorted
+    _stored_totals = [
+        'accrued_total_tax', 'deductible_total', 'result',
+        'liquidation_result',
+        ]
+    # Routing of the fields to the file records computed on first use
+    _file_columns = None
+    # Margin for the transactions posting moves to be committed
+    _snapshot_margin = datetime.timedelta(hours=1)
+    _period_ids_cache = Cache('aeat.303.report.get_period_ids',
+        context=False)
+    _tax_code_closure_cache = Cache('aeat.303.report.tax_code_closure',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -549,9 +1263,15 @@ class Report(Workflow, ModelSQL, ModelView):
                     },
                 'calculate': {
                     'invisible': ~Eval('state').in_(['draft']),
+                    'readonly': Eval('queue_state').in_(
+                        ['queued', 'running']),
+                    'depends': ['queue_state'],
                     },
                 'process': {
                     'invisible': ~Eval('state').in_(['calculated']),
+                    'readonly': Eval('queue_state').in_(
+                        ['queued', 'running']),
+                    'depends': ['queue_state'],
                     },
                 'cancel': {
                     'invisible': Eval('state').in_(['cancelled']),
@@ -593,9 +1313,43 @@ class Report(Workflow, ModelSQL, ModelView):
             'complementary_declaration')
         joint_presentation_allowed = table.column_exist(
             'joint_presentation_allowed')
+        file_id = table.column_exist('file_id')
+        stored_totals = table.column_exist('result')
 
         super(Report, cls).__register__(module_name)
 
+        # Migration from 6.0: store the totals
+        if not stored_totals:
+            columns = [Column(model_table, f)
+                for f in cls._total_amount_fields]
+            cursor.execute(*model_table.select(model_table.id, *columns))
+            update_cursor = Transaction().connection.cursor()
+            for row in cursor:
+                values = {f: Decimal(str(v)) if v is not None else None
+                    for f, v in zip(cls._total_amount_fields, row[1:])}
+                totals = cls.compute_totals(values)
+                update_cursor.execute(*model_table.update(
+                        [Column(model_table, f) for f in cls._stored_totals],
+                        [totals[f].quantize(Decimal('0.01'))
+                            for f in cls._stored_totals],
+                        where=model_table.id == row[0]))
+
+        # Migration from 6.0: move the files to the filestore
+        if not file_id:
+            prefix = Transaction().database.name
+            cursor.execute(*model_table.select(model_table.id,
+                    where=model_table.file_ != Null))
+            for report_id, in cursor.fetchall():
+                cursor.execute(*model_table.select(model_table.file_,
+                        where=model_table.id == report_id))
+                data, = cursor.fetchone()
+                if isinstance(data, str):
+                    data = data.encode('utf-8')
+                cursor.execute(*model_table.update(
+                        [model_table.file_id, model_table.file_],
+                        [filestore.set(bytes(data), prefix=prefix), Null],
+                        where=model_table.id == report_id))
+
         # Migration to model 303 of 2015
         if not regime_type and table.column_exist('simplificated_regime'):
             # Don't use UPDATE FROM because SQLite nor MySQL support it.
@@ -806,6 +1560,11 @@ class Report(Workflow, ModelSQL, ModelView):
     def default_regime_type():
         return '3'
 
+    @classmethod
+    def get_company_party(cls, reports, name):
+        # The companies share the cache of the reports so they are read once
+        return {r.id: r.company.party.id for r in reports}
+
     @fields.depends('company')
     def on_change_with_company_party(self, name=None):
         if self.company:
@@ -860,62 +1619,86 @@ class Report(Workflow, ModelSQL, ModelView):
             if self.previous_report else _Z)
         self.on_change_previous_period_pending_amount_to_compensate()
 
-    def get_currency(self, name):
-        return self.company.currency.id
-
-    def get_general_regime_result(self, name):
-        return (self.accrued_total_tax or _Z) - (self.deductible_total or _Z)
-
-    def get_accrued_total_tax(self, name):
-        return ((self.accrued_vat_tax_1 or _Z) +
-            (self.accrued_vat_tax_2 or _Z) +
-            (self.accrued_vat_tax_3 or _Z) +
-            (self.intracommunity_adquisitions_tax or _Z) +
-            (self.other_passive_subject_tax or _Z) +
-            (self.accrued_vat_tax_modification or _Z) +
-            (self.accrued_re_tax_1 or _Z) +
-            (self.accrued_re_tax_2 or _Z) +
-            (self.accrued_re_tax_3 or _Z) +
-            (self.accrued_re_tax_modification or _Z)
-                )
-
-    def get_deductible_total(self, name):
-        return ((self.deductible_current_domestic_operations_tax or _Z) +
-            (self.deductible_investment_domestic_operations_tax or _Z) +
-            (self.deductible_current_import_operations_tax or _Z) +
-            (self.deductible_investment_import_operations_tax or _Z) +
-            (self.deductible_current_intracommunity_operations_tax or _Z) +
-            (self.deductible_investment_intracommunity_operations_tax or _Z) +
-            (self.deductible_regularization_tax or _Z) +
-            (self.deductible_compensations or _Z) +
-            (self.deductible_investment_regularization or _Z) +
-            (self.deductible_pro_rata_regularization or _Z)
-                )
-
-    def get_sum_results(self, name):
+    @classmethod
+    def get_currency(cls, reports, name):
+        return {r.id: r.company.currency.id for r in reports}
+
+    @classmethod
+    def compute_totals(cls, values):
+        "Return the totals computed from the dictionary of amounts values"
+        def get(name):
+            return values[name] or _Z
+
+        totals = {}
+        totals['accrued_total_tax'] = sum(
+            (get(f) for f in cls._accrued_tax_fields), _Z)
+        totals['deductible_total'] = sum(
+            (get(f) for f in cls._deductible_fields), _Z)
+        totals['general_regime_result'] = (
+            totals['accrued_total_tax'] - totals['deductible_total'])
+        totals['state_administration_amount'] = (
+            totals['general_regime_result']
+            * get('state_administration_percent') / Decimal('100.0'))
+        totals['result_previous_period_amount_to_compensate'] = (
+            get('previous_period_pending_amount_to_compensate')
+            - get('previous_period_amount_to_compensate'))
         # Here have to sum the box 46 + 58 + 76. The 58 is only for There
         #  Regime Simplified. By the moment this type are not supported so
         #  only sum 46 + 76.
-        return ((self.general_regime_result or _Z) +
-            (self.result_tax_regularitzation or _Z))
+        totals['sum_results'] = (totals['general_regime_result']
+            + get('result_tax_regularitzation'))
+        totals['result'] = (totals['state_administration_amount']
+            + get('aduana_tax_pending')
+            - get('previous_period_amount_to_compensate')
+            + get('joint_taxation_state_provincial_councils'))
+        totals['liquidation_result'] = totals['result'] - get('to_deduce')
+        return totals
 
-    def get_state_administration_amount(self, name):
-        return (self.general_regime_result
-            * (self.state_administration_percent or _Z)
-            / Decimal('100.0'))
+    @classmethod
+    def get_totals(cls, reports, names):
+        '''
+        Return the computed totals of names for the reports.
+        They are computed in a single pass from one read of the amounts they
+        depend on.
+        '''
+        result = {n: {} for n in names}
+        for values in cls.read(
+                [r.id for r in reports], cls._total_amount_fields):
+            totals = cls.compute_totals(values)
+            for name in names:
+                result[name][values['id']] = totals[name]
+        return result
 
-    def get_result_previous_period_amount_to_compensate(self, name):
-        return ((self.previous_period_pending_amount_to_compensate or _Z)
-            - (self.previous_period_amount_to_compensate or _Z))
+    @classmethod
+    def store_totals(cls, reports):
+        "Store the totals of the reports computed from their amounts"
+        to_write = []
+        for values in cls.read(
+                [r.id for r in reports], cls._total_amount_fields):
+            totals = cls.compute_totals(values)
+            to_write.extend([[cls(values['id'])], {
+                        n: totals[n].quantize(Decimal('0.01'))
+                        for n in cls._stored_totals
+                        }])
+        if to_write:
+            super(Report, cls).write(*to_write)
 
-    def get_result(self, name):
-        return ((self.state_administration_amount or _Z)
-            + (self.aduana_tax_pending or _Z)
-            - (self.previous_period_amount_to_compensate or _Z)
-            + (self.joint_taxation_state_provincial_councils or _Z))
+    @classmethod
+    def create(cls, vlist):
+        reports = super(Report, cls).create(vlist)
+        cls.store_totals(reports)
+        return reports
 
-    def get_liquidation_result(self, name):
-        return self.result - self.to_deduce
+    @classmethod
+    def write(cls, *args):
+        super(Report, cls).write(*args)
+        amount_fields = set(cls._total_amount_fields)
+        actions = iter(args)
+        to_store = []
+        for reports, values in zip(actions, actions):
+            if amount_fields.intersection(values):
+                to_store.extend(reports)
+        cls.store_totals(to_store)
 
     def get_filename(self, name):
         return 'aeat303-%s-%s.txt' % (
@@ -923,8 +1706,14 @@ class Report(Workflow, ModelSQL, ModelView):
 
     @classmethod
     def validate(cls, reports):
+        # The currency is the one of the company so it is checked only once
+        # by company
+        company_reports = {}
         for report in reports:
+            company_reports.setdefault(report.company.id, report)
+        for report in company_reports.values():
             report.check_euro()
+        for report in reports:
             report.check_compensate()
 
     def check_euro(self):
@@ -942,60 +1731,601 @@ class Report(Workflow, ModelSQL, ModelView):
             raise UserError(gettext('aeat_303.msg_invalid_compensate'))
 
     @classmethod
-    @ModelView.button
-    @Workflow.transition('calculated')
-    def calculate(cls, reports):
+    def get_period_ids(cls, fiscalyear, period):
+        "Return the ids of the account periods of the 303 period code"
+        period_ids = cls._period_ids_cache.get(fiscalyear.id)
+        if period_ids is None:
+            period_ids = cls.get_fiscalyear_period_ids(fiscalyear)
+            cls._period_ids_cache.set(fiscalyear.id, period_ids)
+        return period_ids.get(period, [])
+
+    @classmethod
+    def get_fiscalyear_period_ids(cls, fiscalyear):
+        '''
+        Return a dictionary of each 303 period code to the ids of the account
+        periods of the fiscal year that it includes.
+        '''
         pool = Pool()
-        Mapping = pool.get('aeat.303.mapping')
         Period = pool.get('account.period')
-        TaxCode = pool.get('account.tax.code')
 
-        mapping = {}
-        fixed = {}
-        for mapp in Mapping.search([('type_', '=', 'code')]):
-            for code in mapp.code:
-                mapping[code.id] = mapp.aeat303_field.name
-        for mapp in Mapping.search([('type_', '=', 'numeric')]):
-            fixed[mapp.aeat303_field.name] = mapp.number
-
-        if len(fixed) == 0:
-            raise UserError(gettext('aeat_303.msg_no_config'))
-
-        for report in reports:
-            fiscalyear = report.fiscalyear
-            period = report.period
-            if 'T' in period:
-                period = period[0]
-                start_month = (int(period) - 1) * 3 + 1
+        year = fiscalyear.start_date.year
+        periods = Period.search([
+                ('fiscalyear', '=', fiscalyear.id),
+                ])
+        result = {}
+        for code, _ in cls.period.selection:
+            if 'T' in code:
+                start_month = (int(code[0]) - 1) * 3 + 1
                 end_month = start_month + 2
             else:
-                start_month = int(period)
+                start_month = int(code)
                 end_month = start_month
 
-            year = fiscalyear.start_date.year
             lday = calendar.monthrange(year, end_month)[1]
-            periods = [p.id for p in Period.search([
-                    ('fiscalyear', '=', fiscalyear.id),
-                    ('start_date', '>=', datetime.date(year, start_month, 1)),
-                    ('end_date', '<=', datetime.date(year, end_month, lday))
-                    ])]
-
-            for field, value in fixed.items():
-                setattr(report, field, value)
-            for field in mapping.values():
-                setattr(report, field, Decimal('0.0'))
-            with Transaction().set_context(periods=periods):
-                for tax in TaxCode.browse(mapping.keys()):
-                    value = getattr(report, mapping[tax.id])
-                    setattr(report, mapping[tax.id], value + tax.amount)
-            report.save()
+            start_date = datetime.date(year, start_month, 1)
+            end_date = datetime.date(year, end_month, lday)
+            result[code] = [p.id for p in periods
+                if p.start_date >= start_date and p.end_date <= end_date]
+        return result
+
+    @classmethod
+    def get_tax_code_closure(cls, codes):
+        '''
+        Return a dictionary of tax code id to the tuple of the pairs of id and
+        parent id of all its descendants.
+        The parents always come before their children. The closures are
+        cached until the tax codes are modified and the missing ones are
+        computed together with a query by level of the tree.
+        '''
+        pool = Pool()
+        TaxCode = pool.get('account.tax.code')
+        cursor = Transaction().connection.cursor()
+        table = TaxCode.__table__()
 
+        closure, missing = {}, []
+        for code_id in {int(c) for c in codes}:
+            pairs = cls._tax_code_closure_cache.get(code_id)
+            if pairs is None:
+                missing.append(code_id)
+            else:
+                closure[code_id] = pairs
+        if not missing:
+            return closure
+
+        children = defaultdict(list)
+        parents = expanded = set(missing)
+        while parents:
+            next_parents = set()
+            for sub_ids in grouped_slice(parents):
+                cursor.execute(*table.select(table.id, table.parent,
+                        where=reduce_ids(table.parent, list(sub_ids)),
+                        order_by=table.id))
+                for code_id, parent_id in cursor:
+                    children[parent_id].append(code_id)
+                    next_parents.add(code_id)
+            # A missing code may be a descendant of another one
+            parents = next_parents - expanded
+            expanded = expanded | parents
+        for code_id in missing:
+            pairs = []
+            queue = [code_id]
+            # The queue grows while it is iterated to walk the tree by level
+            for parent_id in queue:
+                for child_id in children[parent_id]:
+                    pairs.append((child_id, parent_id))
+                    queue.append(child_id)
+            closure[code_id] = pairs = tuple(pairs)
+            cls._tax_code_closure_cache.set(code_id, pairs)
+        return closure
+
+    @classmethod
+    def get_tax_code_childs(cls, codes, periods_list):
+        '''
+        Return for each list of periods of periods_list the active tax codes
+        of codes and their children.
+        '''
+        pool = Pool()
+        Period = pool.get('account.period')
+        TaxCode = pool.get('account.tax.code')
+
+        code_ids = [int(c) for c in codes]
+        closure = cls.get_tax_code_closure(code_ids)
+        tree_ids = set(code_ids).union(
+            *({c for c, _ in p} for p in closure.values()))
+        # The active children depend on the fiscal years of the periods
+        fiscalyear2childs = {}
+        result = []
+        for periods in periods_list:
+            fiscalyears = frozenset(
+                p.fiscalyear.id for p in Period.browse(periods))
+            if fiscalyears not in fiscalyear2childs:
+                with Transaction().set_context(periods=list(periods)):
+                    fiscalyear2childs[fiscalyears] = TaxCode.search([
+                            ('id', 'in', list(tree_ids)),
+                            ])
+            result.append(fiscalyear2childs[fiscalyears])
+        return result
+
+    @classmethod
+    def get_tax_code_totals(cls, codes, periods, boundary=None, since=None,
+            counts=None):
+        '''
+        Return a dictionary of tax code id to a dictionary of period id to
+        the tuple of not rounded totals of the lines of the tax codes.
+        The first total is the one of the lines of moves posted before
+        boundary and not modified since and the second one the one of the
+        other lines.
+        If since is set, the lines that were stable at that date are skipped.
+        If counts is a dictionary, the number of lines aggregated for each
+        tax code is added to it.
+        The lines of all the codes and periods are aggregated with a single
+        query grouped by tax code and move period.
+        '''
+        pool = Pool()
+        TaxCodeLine = pool.get('account.tax.code.line')
+        Tax = pool.get('account.tax')
+        TaxLine = pool.get('account.tax.line')
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        cursor = Transaction().connection.cursor()
+
+        code_line = TaxCodeLine.__table__()
+        tax_line = TaxLine.__table__()
+        move_line = MoveLine.__table__()
+        move = Move.__table__()
+
+        with Transaction().set_context(periods=list(periods)):
+            where = Tax._amount_where(tax_line, move_line, move)
+
+        amount = tax_line.amount
+        debit = move_line.debit
+        credit = move_line.credit
+        if backend.name == 'sqlite':
+            amount = TaxLine.amount.sql_cast(tax_line.amount)
+            debit = MoveLine.debit.sql_cast(debit)
+            credit = MoveLine.credit.sql_cast(credit)
+        is_invoice = (
+            ((amount > 0) & ((debit > 0) | (credit > 0)))
+            | ((amount < 0) & ((debit < 0) | (credit < 0)))
+            )
+        is_credit = (
+            ((amount < 0) & ((debit > 0) | (credit > 0)))
+            | ((amount > 0) & ((debit < 0) | (credit < 0)))
+            )
+        # Credit lines and "-" operator negate the value but not both
+        sign = Case(
+            ((code_line.type == 'credit') & (code_line.operator == '-'), 1),
+            ((code_line.type == 'credit') | (code_line.operator == '-'), -1),
+            else_=1)
+
+        # The lines of posted moves can only be changed through their tax
+        # lines which discard the snapshots so they are stable
+        def stable_at(date):
+            return ((move.state == 'posted')
+                & (Coalesce(move.write_date, move.create_date) <= date)
+                & (Coalesce(tax_line.write_date, tax_line.create_date)
+                    <= date))
+        if boundary:
+            stable = stable_at(boundary)
+        else:
+            stable = Literal(False)
+        if since:
+            where &= ~stable_at(since)
+
+        totals = {}
+        for sub_codes in grouped_slice(codes):
+            query = (code_line
+                .join(tax_line, condition=(tax_line.tax == code_line.tax)
+                    & (tax_line.type == code_line.amount))
+                .join(move_line, condition=tax_line.move_line == move_line.id)
+                .join(move, condition=move_line.move == move.id)
+                .select(code_line.code, move.period,
+                    Sum(Case((stable, amount * sign), else_=0)),
+                    Sum(Case((stable, 0), else_=amount * sign)),
+                    Count(),
+                    where=reduce_ids(code_line.code,
+                        [int(c) for c in sub_codes])
+                    & (((code_line.type == 'invoice') & is_invoice)
+                        | ((code_line.type == 'credit') & is_credit))
+                    & (move_line.state != 'draft')
+                    & where,
+                    group_by=[code_line.code, move.period]))
+            cursor.execute(*query)
+            for code_id, period_id, stable_value, value, count in cursor:
+                if not isinstance(stable_value, Decimal):
+                    stable_value = Decimal(str(stable_value or 0))
+                if not isinstance(value, Decimal):
+                    value = Decimal(str(value or 0))
+                totals.setdefault(code_id, {})[period_id] = (
+                    stable_value, value)
+                if counts is not None:
+                    counts[code_id] = counts.get(code_id, 0) + count
+        return totals
+
+    @classmethod
+    def round_tax_code_totals(cls, codes, childs, totals):
+        '''
+        Return a dictionary with the amount of each tax code of codes from the
+        not rounded totals of childs.
+        Each code is rounded as account.tax.code does before being summed to
+        its parents, so the amount of a code is the sum of the rounded totals
+        of its closure. Only the descendants reached through childs count.
+        '''
+        code_totals = {}
+        for code in childs:
+            exp = Decimal(str(10.0 ** -code.currency_digits))
+            code_totals[code.id] = totals.get(
+                code.id, Decimal(0)).quantize(exp)
+
+        return {code_id: sum((code_totals.get(c, Decimal(0))
+                        for c in descendants), Decimal(0))
+            for code_id, descendants in cls.get_tax_code_descendants(
+                codes, childs).items()}
+
+    @classmethod
+    def get_tax_code_descendants(cls, codes, childs):
+        '''
+        Return a dictionary of tax code id of codes to the list of its id
+        and the ids of its descendants in childs that are reached through
+        codes in childs.
+        '''
+        child_ids = {int(c) for c in childs}
+        closure = cls.get_tax_code_closure(codes)
+        result = {}
+        for code_id in {int(c) for c in codes}:
+            reached, seen = [code_id], {code_id}
+            for child_id, parent_id in closure[code_id]:
+                if parent_id in seen and child_id in child_ids:
+                    reached.append(child_id)
+                    seen.add(child_id)
+            result[code_id] = reached
+        return result
+
+    @classmethod
+    def get_tax_code_amounts(cls, codes, periods_list):
+        '''
+        Return for each list of periods of periods_list a dictionary with the
+        amount of each tax code.
+        It gives the same result as the amount field of account.tax.code but
+        the tax lines of all the codes, and their children, are aggregated
+        for all the periods with a single query.
+        '''
+        childs_list = cls.get_tax_code_childs(codes, periods_list)
+        totals = cls.get_tax_code_totals(
+            set().union(*childs_list), set().union(*periods_list))
+        result = []
+        for periods, childs in zip(periods_list, childs_list):
+            code_totals = {}
+            for code in childs:
+                period_totals = totals.get(code.id, {})
+                code_totals[code.id] = sum(
+                    (sum(period_totals.get(p, ()), Decimal(0))
+                        for p in periods), Decimal(0))
+            result.append(cls.round_tax_code_totals(
+                    codes, childs, code_totals))
+        return result
+
+    @classmethod
+    def get_box_amounts(cls, mapping, amounts):
+        '''
+        Return a dictionary with the total of each AEAT box from the amounts
+        of the tax codes.
+        mapping is a dictionary of tax code id to the box field name.
+        '''
+        boxes = dict.fromkeys(mapping.values(), Decimal('0.0'))
+        for code_id, field in mapping.items():
+            boxes[field] += amounts[code_id]
+        return boxes
+
+    def get_snapshot_since(self, periods, childs, changes, lines):
+        '''
+        Return the date since which the tax lines must be aggregated to
+        complete the snapshot or None if it can not be used.
+        changes is a dictionary of tax code id to the last date its lines
+        were modified and lines a dictionary of tax code id to the ids of its
+        lines.
+        '''
+        snapshot = self.snapshot
+        since = self.snapshot_date
+        if not snapshot or not since:
+            return
+        if snapshot.get('periods') != list(periods):
+            return
+        if set(snapshot.get('codes', [])) != {c.id for c in childs}:
+            return
+        # The lines deleted or moved to another code do not change the date
+        if snapshot.get('lines') != sorted(
+                l for c in childs for l in lines.get(c.id, [])):
+            return
+        if any(changes.get(c.id) and changes[c.id] > since for c in childs):
+            return
+        return since
+
+    @classmethod
+    def get_tax_code_changes(cls, codes):
+        '''
+        Return a dictionary of tax code id to the last change of its lines
+        and a dictionary of tax code id to the ids of its lines.
+        '''
+        pool = Pool()
+        TaxCodeLine = pool.get('account.tax.code.line')
+        cursor = Transaction().connection.cursor()
+        code_line = TaxCodeLine.__table__()
+
+        changes, lines = {}, defaultdict(list)
+        for sub_codes in grouped_slice(codes):
+            cursor.execute(*code_line.select(code_line.code, code_line.id,
+                    Coalesce(code_line.write_date, code_line.create_date),
+                    where=reduce_ids(code_line.code,
+                        [int(c) for c in sub_codes]),
+                    order_by=code_line.id))
+            for code_id, line_id, date in cursor:
+                if isinstance(date, str):
+                    date = datetime.datetime.fromisoformat(date)
+                if code_id not in changes or date > changes[code_id]:
+                    changes[code_id] = date
+                lines[code_id].append(line_id)
+        return changes, lines
+
+    @classmethod
+    def clear_snapshots(cls, moves):
+        '''
+        Discard the snapshots of the reports that may contain the tax lines
+        of the posted moves.
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        keys = {(m.company.id, m.period.fiscalyear.id)
+            for m in moves if m.state == 'posted'}
+        if not keys:
+            return
+        for sub_keys in grouped_slice(sorted(keys)):
+            where = Literal(False)
+            for company_id, fiscalyear_id in sub_keys:
+                where |= ((table.company == company_id)
+                    & (table.fiscalyear == fiscalyear_id))
+            cursor.execute(*table.update(
+                    [table.snapshot, table.snapshot_date], [Null, Null],
+                    where=where & (table.snapshot_date != Null)))
+        # Clean the caches of the reports as write does
+        transaction.counter += 1
+        for cache in transaction.cache.values():
+            cache.pop(cls.__name__, None)
+
+    @classmethod
+    def push_queue(cls, method, reports):
+        '''
+        Push the method of the reports into the queue with a task for each
+        company and chunk of reports.
+        '''
+        batch = config.getint('aeat_303', 'queue_batch', default=100)
         cls.write(reports, {
-                'calculation_date': datetime.datetime.now(),
+                'queue_state': 'queued',
+                'queue_error': None,
                 })
+        company2reports = defaultdict(list)
+        for report in reports:
+            company2reports[report.company].append(report)
+        with Transaction().set_context(_aeat_303_queued=True):
+            for company_reports in company2reports.values():
+                for sub_reports in grouped_slice(company_reports, batch):
+                    getattr(cls.__queue__, method)(list(sub_reports))
+
+    @classmethod
+    def run_queued(cls, func, reports):
+        '''
+        Run func on the reports from a queue task.
+        If it fails, the reports are run one by one to store the error on the
+        failing ones.
+        '''
+        transaction = Transaction()
+        ids = [r.id for r in reports]
+        cls.write(reports, {'queue_state': 'running'})
+        transaction.commit()
+        try:
+            func(cls, cls.browse(ids))
+        except backend.DatabaseOperationalError:
+            raise
+        except Exception:
+            transaction.rollback()
+            for report in cls.browse(ids):
+                try:
+                    func(cls, [report])
+                except backend.DatabaseOperationalError:
+                    raise
+                except Exception as exception:
+                    logger.warning('%s of AEAT 303 report %s failed',
+                        func.__name__, report.id, exc_info=True)
+                    transaction.rollback()
+                    cls.write([cls(report.id)], {
+                            'queue_state': 'failed',
+                            'queue_error': getattr(
+                                exception, 'message', str(exception)),
+                            })
+                else:
+                    cls.write([report], {'queue_state': None})
+                transaction.commit()
+        else:
+            cls.write(cls.browse(ids), {'queue_state': None})
+
+    @classmethod
+    def calculate_by_company(cls, reports, processes=None):
+        '''
+        Calculate the reports of each company in its own transaction using a
+        pool of processes and return a dictionary of company id to the error
+        message if it failed.
+        The reports must be committed to be seen by the processes.
+        '''
+        transaction = Transaction()
+        if not processes:
+            processes = config.getint('aeat_303', 'processes',
+                default=multiprocessing.cpu_count())
+
+        company2ids = defaultdict(list)
+        for report in sorted(reports, key=lambda r: (r.company.id, r.id)):
+            company2ids[report.company.id].append(report.id)
+        companies = sorted(company2ids)
+
+        context = transaction.context.copy()
+        context.pop('_request', None)
+        settings = {s: dict(config.items(s)) for s in config.sections()}
+        args = [(transaction.database.name, transaction.user, context,
+                company2ids[c]) for c in companies]
+        # Spawn the processes to not share the database connections
+        mp_context = multiprocessing.get_context('spawn')
+        with mp_context.Pool(min(processes, len(args) or 1),
+                _calculate_init, (settings,)) as mpool:
+            errors = mpool.starmap(_calculate_company, args)
+        return dict(zip(companies, errors))
+
+    @classmethod
+    def calculate_draft(cls):
+        "Calculate the draft reports of all the companies"
+        reports = cls.search([('state', '=', 'draft')])
+        for company, error in cls.calculate_by_company(reports).items():
+            if error:
+                logger.error(
+                    'calculate of AEAT 303 reports of company %s failed: %s',
+                    company, error)
+
+    @classmethod
+    def log_timings(cls, method, reports, timings):
+        '''
+        Report the duration of the phases of method on the reports.
+        It can be extended to send them to a monitoring system.
+        '''
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('%s of AEAT 303 reports %s: %s', method,
+                [r.id for r in reports], ', '.join(
+                    '%s=%s' % (k, v) for k, v in sorted(timings.items())))
 
     @classmethod
     @ModelView.button
+    @queued
+    @Workflow.transition('calculated')
+    def calculate(cls, reports):
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Line = pool.get('aeat.303.report.line')
+        Field = pool.get('ir.model.field')
+
+        timer = Timer()
+        # Reports sharing the same periods are aggregated only once
+        groups = defaultdict(list)
+        with timer('periods'):
+            for report in reports:
+                periods = cls.get_period_ids(
+                    report.fiscalyear, report.period)
+                key = (
+                    report.company.id, report.fiscalyear.id, tuple(periods))
+                groups[key].append(report)
+
+        compiled = {}
+        with timer('mapping'):
+            for company in {k[0] for k in groups}:
+                mapping, fixed = compiled[company] = Mapping.get_compiled(
+                    company)
+                if len(fixed) == 0:
+                    raise UserError(gettext('aeat_303.msg_no_config'))
+
+        keys = list(groups.keys())
+        with timer('codes'):
+            childs_list = cls.get_tax_code_childs(
+                set().union(*(compiled[k[0]][0].keys() for k in keys)),
+                [k[2] for k in keys])
+            key2childs = dict(zip(keys, childs_list))
+            changes, code_lines = cls.get_tax_code_changes(
+                set().union(*childs_list))
+
+        # A report with a valid snapshot only aggregates the lines that were
+        # not stable when it was taken
+        since2reports = defaultdict(list)
+        with timer('snapshot'):
+            for key in keys:
+                for report in groups[key]:
+                    since = report.get_snapshot_since(
+                        key[2], key2childs[key], changes, code_lines)
+                    since2reports[since].append((key, report))
+
+        calculation_date = datetime.datetime.now()
+        # Leave a margin for the transactions not yet committed and store it
+        # without the microseconds like the snapshot date
+        boundary = (calculation_date - cls._snapshot_margin).replace(
+            microsecond=0)
+        counts = {}
+        # The amount of each box and tax code is kept as a line
+        line_values = []
+        for since, key_reports in since2reports.items():
+            with timer('aggregation'):
+                totals = cls.get_tax_code_totals(
+                    set().union(*(key2childs[k] for k, _ in key_reports)),
+                    set().union(*(k[2] for k, _ in key_reports)),
+                    boundary=boundary, since=since, counts=counts)
+            with timer('boxes'):
+                for key, report in key_reports:
+                    mapping, fixed = compiled[key[0]]
+                    childs = key2childs[key]
+                    snapshot = (report.snapshot or {}).get('totals', {}) \
+                        if since else {}
+                    stable_totals = {}
+                    code_totals = {}
+                    for code in childs:
+                        period_totals = totals.get(code.id, {})
+                        stable_total = Decimal(snapshot.get(str(code.id), 0))
+                        total = Decimal(0)
+                        for period in key[2]:
+                            stable_value, value = period_totals.get(
+                                period, (Decimal(0), Decimal(0)))
+                            stable_total += stable_value
+                            total += value
+                        stable_totals[str(code.id)] = stable_total
+                        code_totals[code.id] = stable_total + total
+                    amounts = cls.round_tax_code_totals(
+                        mapping.keys(), childs, code_totals)
+
+                    for field, value in fixed.items():
+                        setattr(report, field, value)
+                    for field, value in cls.get_box_amounts(
+                            mapping, amounts).items():
+                        setattr(report, field, value)
+                    line_values.extend((report, field, code_id,
+                            amounts[code_id])
+                        for code_id, field in mapping.items())
+                    report.calculation_date = calculation_date
+                    report.snapshot = {
+                        'periods': list(key[2]),
+                        'codes': [c.id for c in childs],
+                        'lines': sorted(l for c in childs
+                            for l in code_lines.get(c.id, [])),
+                        'totals': stable_totals,
+                        }
+                    report.snapshot_date = boundary
+        with timer('save'):
+            cls.save(reports)
+            Line.delete(Line.search([
+                        ('report', 'in', [r.id for r in reports]),
+                        ]))
+            field_ids = {f.name: f.id for f in Field.search([
+                        ('model.model', '=', cls.__name__),
+                        ('name', 'in', list({v[1] for v in line_values})),
+                        ])}
+            Line.create([{
+                        'report': report.id,
+                        'aeat303_field': field_ids[field],
+                        'code': code_id,
+                        'amount': amount,
+                        } for report, field, code_id, amount in line_values])
+
+        timings = dict(timer.timings,
+            rows=sum(counts.values()), reports=len(reports))
+        cls.write(reports, {'timings': {'calculate': timings}})
+        cls.log_timings('calculate', reports, timings)
+
+    @classmethod
+    @ModelView.button
+    @queued
     @Workflow.transition('done')
     def process(cls, reports):
         for report in reports:
@@ -1011,51 +2341,501 @@ class Report(Workflow, ModelSQL, ModelView):
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, reports):
-        pass
+        # The file must be created again once recalculated
+        cls.write(reports, {'file_': None})
 
-    def create_file(self):
-        header = Record(aeat303.HEADER_RECORD)
-        footer = Record(aeat303.FOOTER_RECORD)
-        record = Record(aeat303.RECORD)
-        general_record = Record(aeat303.GENERAL_RECORD)
-        additional_record = Record(aeat303.ADDITIONAL_RECORD)
-        columns = [x for x in self.__class__._fields if x not in
-            ('report', 'bank_account')]
-        for column in columns:
+    @classmethod
+    def parse_file(cls, data):
+        '''
+        Return a dictionary with the values of the fields of a report from
+        the content of its file.
+        It raises a UserError if the file does not follow the layout.
+        '''
+        if isinstance(data, bytes):
+            data = data.decode('iso-8859-1')
+        data = data.rstrip('\r\n')
+        if cls._file_columns is None:
+            cls._file_columns = cls.get_file_columns()
+
+        def length(layout):
+            return max(f[0] + f[1] - 1 for f in layout)
+
+        name2record = {}
+        position = 0
+        try:
+            for name, layout in cls.get_file_records():
+                # The additional record is only on the last period
+                if (name == 'additional'
+                        and name2record['header'].period not in ('12', '4T')):
+                    continue
+                end = position + length(layout)
+                if end > len(data):
+                    raise ValueError('record "%s" is truncated' % name)
+                name2record[name] = extract_record(
+                    data[position:end], layout)
+                position = end
+            if position != len(data):
+                raise ValueError('unexpected data at %s' % position)
+        except Exception as exception:
+            raise UserError(gettext('aeat_303.msg_invalid_file',
+                    error=exception))
+
+        values = {}
+        for column, names in cls._file_columns:
+            field = cls._fields[column]
+            if column != 'fiscalyear' and (
+                    isinstance(field, fields.Function)
+                    or field._type in {'many2one', 'one2many', 'many2many'}):
+                continue
+            for name in names:
+                if name in name2record:
+                    values[column] = getattr(name2record[name], column)
+                    break
+        year = values.pop('fiscalyear', None)
+        header = name2record['header']
+        if not year and 'year' in header._fields:
+            year = header.year
+        try:
+            values['fiscalyear_code'] = int(year)
+        except (TypeError, ValueError):
+            raise UserError(gettext('aeat_303.msg_invalid_file',
+                    error='invalid year "%s"' % year))
+        return values
+
+    @classmethod
+    def import_files(cls, files, company, batch=100):
+        '''
+        Create done reports of company from the iterable of name and content
+        of files and return the list of created reports and the list of
+        name and error message of the rejected files.
+        The files are consumed and the reports created by batch.
+        The hash of the exported values is stored so the imported files are
+        kept by regenerate while the values do not change.
+        Each batch is committed and, if it fails, its files are created one
+        by one to reject only the failing ones.
+        '''
+        pool = Pool()
+        FiscalYear = pool.get('account.fiscalyear')
+        transaction = Transaction()
+
+        year2fiscalyear = {}
+
+        def get_fiscalyear(year):
+            if year not in year2fiscalyear:
+                fiscalyears = FiscalYear.search([
+                        ('company', '=', company.id),
+                        ('start_date', '<=', datetime.date(year, 12, 31)),
+                        ('end_date', '>=', datetime.date(year, 1, 1)),
+                        ], order=[('start_date', 'ASC')], limit=1)
+                year2fiscalyear[year] = (
+                    fiscalyears[0].id if fiscalyears else None)
+            return year2fiscalyear[year]
+
+        reports, rejected = [], []
+        files = iter(files)
+        for sub_files in iter(lambda: list(islice(files, batch)), []):
+            to_create = []
+            for name, data in sub_files:
+                try:
+                    values = cls.parse_file(data)
+                except UserError as exception:
+                    rejected.append((name, exception.message))
+                    continue
+                values.update({
+                        'company': company.id,
+                        'fiscalyear': get_fiscalyear(
+                            values['fiscalyear_code']),
+                        'state': 'done',
+                        'file_': data,
+                        })
+                to_create.append((name, values))
+            if not to_create:
+                continue
+            try:
+                created = cls.create_imported([v for _, v in to_create])
+            except backend.DatabaseOperationalError:
+                raise
+            except Exception:
+                transaction.rollback()
+                created = []
+                for name, values in to_create:
+                    try:
+                        created.extend(cls.create_imported([values]))
+                    except backend.DatabaseOperationalError:
+                        raise
+                    except Exception as exception:
+                        logger.warning('import of AEAT 303 file %s failed',
+                            name, exc_info=True)
+                        transaction.rollback()
+                        rejected.append((name, getattr(
+                                    exception, 'message', str(exception))))
+                    else:
+                        transaction.commit()
+            else:
+                transaction.commit()
+            reports.extend(created)
+        return reports, rejected
+
+    @classmethod
+    def create_imported(cls, vlist):
+        '''
+        Create the reports of imported files from the list of values and
+        store the hash of their exported values.
+        '''
+        reports = cls.create(vlist)
+        to_write = []
+        for report in reports:
+            file_values, file_hash = report.get_file_hash()
+            to_write.extend(([report], {
+                        'file_hash': file_hash,
+                        'file_values': file_values,
+                        }))
+        cls.write(*to_write)
+        return reports
+
+    @classmethod
+    def regenerate(cls, reports):
+        '''
+        Create again the files of the done reports whose exported values
+        changed and return a dictionary of report to the changed fields.
+        The files whose exported values are unknown are kept.
+        '''
+        changes = {}
+        for report in reports:
+            if report.state != 'done':
+                continue
+            if report.file_id and not report.file_values:
+                continue
+            report_changes = report.create_file()
+            if report_changes is not None:
+                changes[report] = report_changes
+        return changes
+
+    @classmethod
+    def write_zip(cls, reports, fileobj):
+        '''
+        Write into fileobj a ZIP archive with the file of each calculated or
+        done report creating the missing ones.
+        The reports are browsed by slices but their files are read one by
+        one to keep the memory bounded.
+        '''
+        names = set()
+        with zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for sub_ids in grouped_slice([r.id for r in reports]):
+                for report in cls.browse(sub_ids):
+                    if report.state not in ('calculated', 'done'):
+                        continue
+                    if not report.file_id:
+                        cls(report.id).create_file()
+                    name = '%s/%s' % (
+                        report.company_vat or report.company.id,
+                        report.filename)
+                    if name in names:
+                        name = '%s-%s' % (name, report.id)
+                    names.add(name)
+                    # Reading the file from the browsed report would read
+                    # the files of the whole slice
+                    data, = cls.read([report.id], ['file_'])
+                    archive.writestr(name, data['file_'])
+
+    @classmethod
+    def get_file_records(cls):
+        "Return the list of tuples of name and layout of the file records"
+        return [
+            ('header', aeat303.HEADER_RECORD),
+            ('record', aeat303.RECORD),
+            ('general', aeat303.GENERAL_RECORD),
+            ('additional', aeat303.ADDITIONAL_RECORD),
+            ('footer', aeat303.FOOTER_RECORD),
+            ]
+
+    @classmethod
+    def get_file_columns(cls):
+        '''
+        Return the list of tuples of field name and the names of the file
+        records that contain it.
+        '''
+        record_fields = [(name, Record(layout)._fields)
+            for name, layout in cls.get_file_records()]
+        columns = []
+        for column in cls._fields:
+            if column in ('report', 'bank_account'):
+                continue
+            names = tuple(n for n, f in record_fields if column in f)
+            if names:
+                columns.append((column, names))
+        return columns
+
+    def get_file_values(self):
+        "Return a dictionary with the values exported to the file"
+        cls = self.__class__
+        if cls._file_columns is None:
+            cls._file_columns = cls.get_file_columns()
+        values = {}
+        for column, _ in cls._file_columns:
             value = getattr(self, column, None)
             if not value:
                 continue
             if column == 'fiscalyear':
                 value = str(self.fiscalyear_code)
-            if column in header._fields:
-                setattr(header, column, value)
-            if column in record._fields:
-                setattr(record, column, value)
-            if column in general_record._fields:
-                setattr(general_record, column, value)
-            #If period is diffenret of 12/4T the fourth page will be without
-            #   content.
-            if self.period in ('12', '4T'):
-                if column in additional_record._fields:
-                    setattr(additional_record, column, value)
-            if column in footer._fields:
-                setattr(footer, column, value)
-        record.bankruptcy = bool(self.auto_bankruptcy_declaration != ' ')
+            values[column] = value
         if self.bank_account:
             for number in self.bank_account.numbers:
                 if number.type == 'iban':
-                    general_record.bank_account = number.number_compact
-                    general_record.swift_bank = (
-                        self.bank_account.bank and self.bank_account.bank.bic
-                        or '')
+                    values['bank_account'] = number.number_compact
+                    values['swift_bank'] = (
+                        self.bank_account.bank
+                        and self.bank_account.bank.bic or '')
                     break
-        records = [header, record, general_record]
-        if self.period in ('12', '4T'):
-            records.append(additional_record)
-        records.append(footer)
-        data = retrofix_write(records, separator='')
-        data = remove_accents(data).upper()
-        if isinstance(data, str):
-            data = data.encode('iso-8859-1')
-        self.file_ = self.__class__.file_.cast(data)
-        self.save()
+        return values
+
+    def get_file_hash(self, values=None):
+        '''
+        Return the exported values as strings and their hash.
+        values are the exported values, computed if not set.
+        '''
+        if values is None:
+            values = self.get_file_values()
+        file_values = {k: str(v) for k, v in values.items()}
+        file_hash = hashlib.sha256(json.dumps(
+                file_values, sort_keys=True).encode('utf-8')).hexdigest()
+        return file_values, file_hash
+
+    def create_file(self):
+        '''
+        Create the file of the report unless the exported values are the
+        same as those of the current file.
+        Return the list of the fields that changed since the previous file or
+        None if the file is not created.
+        '''
+        cls = self.__class__
+        timer = Timer()
+        with timer('values'):
+            values = self.get_file_values()
+            file_values, file_hash = self.get_file_hash(values)
+        if self.file_id and self.file_hash == file_hash:
+            return
+        previous = self.file_values or {}
+        changes = sorted(k for k in set(previous) | set(file_values)
+            if previous.get(k) != file_values.get(k))
+
+        #If period is diffenret of 12/4T the fourth page will be without
+        #   content.
+        name2record = {n: Record(l) for n, l in cls.get_file_records()
+            if n != 'additional' or self.period in ('12', '4T')}
+        with timer('fill'):
+            for column, names in cls._file_columns:
+                if column not in values:
+                    continue
+                for name in names:
+                    if name in name2record:
+                        setattr(name2record[name], column, values[column])
+            # Some layouts name the fiscal year column year as parse_file
+            # expects
+            for record in name2record.values():
+                if ('year' in record._fields
+                        and 'fiscalyear' not in record._fields):
+                    record.year = str(self.fiscalyear_code)
+            name2record['record'].bankruptcy = bool(
+                self.auto_bankruptcy_declaration != ' ')
+            if 'bank_account' in values:
+                general_record = name2record['general']
+                general_record.bank_account = values['bank_account']
+                general_record.swift_bank = values['swift_bank']
+        records = list(name2record.values())
+        with timer('write'):
+            data = retrofix_write(records, separator='')
+            data = remove_accents(data, upper=True)
+            if isinstance(data, str):
+                data = data.encode('iso-8859-1')
+        self.file_ = cls.file_.cast(data)
+        self.file_hash = file_hash
+        self.file_values = file_values
+        with timer('save'):
+            self.save()
+
+        timings = dict(timer.timings, records=len(records))
+        cls.write([self], {
+                'timings': dict(self.timings or {}, create_file=timings),
+                })
+        self.log_timings('create_file', [self], timings)
+        if previous and changes:
+            logger.info('file of AEAT 303 report %s changed: %s',
+                self.id, ', '.join(changes))
+        return changes
+
+
+class ReportLine(ModelSQL, ModelView):
+    '''
+    AEAT 303 Report Line
+    '''
+    __name__ = 'aeat.303.report.line'
+
+    report = fields.Many2One('aeat.303.report', 'Report', required=True,
+        ondelete='CASCADE', select=True, readonly=True)
+    aeat303_field = fields.Many2One('ir.model.field', 'Field',
+        domain=[('module', '=', 'aeat_303')], required=True, readonly=True)
+    code = fields.Many2One('account.tax.code', 'Tax Code', required=True,
+        readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReportLine, cls).__setup__()
+        cls._order.insert(0, ('aeat303_field', 'ASC'))
+
+    def get_tax_line_domain(self):
+        '''
+        Return the domain of the tax lines aggregated in the amount of the
+        line.
+        The tax codes are resolved when it is called so the lines are only
+        searched, page by page, by the client.
+        '''
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        Tax = pool.get('account.tax')
+
+        periods = Report.get_period_ids(
+            self.report.fiscalyear, self.report.period)
+        childs, = Report.get_tax_code_childs([self.code], [periods])
+        descendants = set(Report.get_tax_code_descendants(
+                [self.code], childs)[self.code.id])
+        code_lines = [l for c in childs if c.id in descendants
+            for l in c.lines]
+        if code_lines:
+            domain = ['OR'] + [l._line_domain for l in code_lines]
+        else:
+            domain = ('id', '=', None)
+        with Transaction().set_context(periods=periods):
+            return [
+                Tax._amount_domain(),
+                ('move_line.state', '!=', 'draft'),
+                domain,
+                ]
+
+
+class ReportLineOpenTaxLines(Wizard):
+    '''
+    Open AEAT 303 Report Line Tax Lines
+    '''
+    __name__ = 'aeat.303.report.line.open_tax_lines'
+    start_state = 'open_'
+    open_ = StateAction('account.act_tax_line_form')
+
+    def do_open_(self, action):
+        action['name'] += ' (%s)' % self.record.code.rec_name
+        action['pyson_domain'] = PYSONEncoder().encode(
+            self.record.get_tax_line_domain())
+        return action, {}
+
+
+class ReportLineOpenMoveLines(Wizard):
+    '''
+    Open AEAT 303 Report Line Move Lines
+    '''
+    __name__ = 'aeat.303.report.line.open_move_lines'
+    start_state = 'open_'
+    open_ = StateAction('account.act_move_line_form')
+
+    def do_open_(self, action):
+        action['name'] += ' (%s)' % self.record.code.rec_name
+        action['pyson_domain'] = PYSONEncoder().encode([
+                ('tax_lines', 'where', self.record.get_tax_line_domain()),
+                ])
+        return action, {}
+
+
+class ExportReportResult(ModelView):
+    '''
+    AEAT 303 Export Result
+    '''
+    __name__ = 'aeat.303.report.export.result'
+
+    file_ = fields.Binary('File', filename='filename', readonly=True)
+    filename = fields.Char('File Name', readonly=True)
+
+
+class ExportReport(Wizard):
+    '''
+    AEAT 303 Export
+    '''
+    __name__ = 'aeat.303.report.export'
+
+    start_state = 'result'
+    result = StateView('aeat.303.report.export.result',
+        'aeat_303.aeat_303_report_export_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_result(self, fields):
+        Report = Pool().get('aeat.303.report')
+        with tempfile.TemporaryFile() as fileobj:
+            Report.write_zip(self.records, fileobj)
+            fileobj.seek(0)
+            data = fileobj.read()
+        return {
+            'file_': data,
+            'filename': 'aeat303.zip',
+            }
+
+
+class ImportReportStart(ModelView):
+    '''
+    AEAT 303 Import Start
+    '''
+    __name__ = 'aeat.303.report.import.start'
+
+    company = fields.Many2One('company.company', 'Company', required=True)
+    file_ = fields.Binary('File', required=True,
+        help='An AEAT 303 file or a ZIP archive of them.')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class ImportReportResult(ModelView):
+    '''
+    AEAT 303 Import Result
+    '''
+    __name__ = 'aeat.303.report.import.result'
+
+    imported = fields.Integer('Imported', readonly=True)
+    rejected = fields.Text('Rejected', readonly=True)
+
+
+class ImportReport(Wizard):
+    '''
+    AEAT 303 Import
+    '''
+    __name__ = 'aeat.303.report.import'
+
+    start = StateView('aeat.303.report.import.start',
+        'aeat_303.aeat_303_report_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('aeat.303.report.import.result',
+        'aeat_303.aeat_303_report_import_result_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def transition_import_(self):
+        Report = Pool().get('aeat.303.report')
+        fileobj = io.BytesIO(self.start.file_)
+        if zipfile.is_zipfile(fileobj):
+            files = iter_files(fileobj)
+        else:
+            files = [('', self.start.file_)]
+        reports, rejected = Report.import_files(files, self.start.company)
+        self.result.imported = len(reports)
+        self.result.rejected = '\n'.join(
+            '%s: %s' % (name, error) for name, error in rejected)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'imported': self.result.imported,
+            'rejected': self.result.rejected,
+            }
@@ -0,0 +1,395 @@
+# This file is part of the aeat_303 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the AEAT 303 module
+
+Fill a test database with synthetic companies, periods and moves with tax
+lines and time calculate, create_file and the chart wizards. The database is
+chosen like for the tests with the DB_NAME and TRYTOND_DATABASE_URI
+environment variables, which must be set before running it, and the generated
+data is rolled back at the end.
+
+    DB_NAME=:memory: python -m trytond.modules.aeat_303.tests.benchmark_aeat_303 \\
+        --companies 2 --periods 3 --moves 1000 --output bench.json
+
+The results can be compared with a previous run with --compare.
+'''
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import wraps
+from unittest.mock import patch
+
+from trytond import backend
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+
+BUCKET = 100
+
+
+@contextmanager
+def measure(results, name, **counts):
+    "Append to results the duration of the block and the rate of counts"
+    start = time.perf_counter()
+    yield
+    seconds = time.perf_counter() - start
+    results.append({
+            'name': name,
+            'seconds': seconds,
+            'counts': counts,
+            'rates': {k: v / seconds for k, v in counts.items()},
+            })
+
+
+def timed(cls, name, durations):
+    "Patch the method name of cls to append its durations"
+    method = getattr(cls, name)
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            durations.append(time.perf_counter() - start)
+    return patch.object(cls, name, wrapper)
+
+
+def spied(cls, name, values):
+    "Patch the method name of cls to append its results"
+    method = getattr(cls, name)
+
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        result = method(*args, **kwargs)
+        values.append(result)
+        return result
+    return patch.object(cls, name, wrapper)
+
+
+def create_templates():
+    "Create a tax and its code templates mapped to the general regime boxes"
+    pool = Pool()
+    AccountTemplate = pool.get('account.account.template')
+    TaxTemplate = pool.get('account.tax.template')
+    TaxCodeTemplate = pool.get('account.tax.code.template')
+    MappingTemplate = pool.get('aeat.303.template.mapping')
+    ModelData = pool.get('ir.model.data')
+
+    template = AccountTemplate(ModelData.get_id(
+            'account', 'account_template_root_en'))
+    tax_account = AccountTemplate(ModelData.get_id(
+            'account', 'account_template_tax_en'))
+    with Transaction().set_user(0):
+        tax, = TaxTemplate.create([{
+                    'name': '21% VAT',
+                    'description': '21% VAT',
+                    'type': 'percentage',
+                    'rate': Decimal('0.21'),
+                    'account': template.id,
+                    'invoice_account': tax_account.id,
+                    'credit_note_account': tax_account.id,
+                    }])
+
+        def code(name, amount):
+            return {
+                'name': name,
+                'account': template.id,
+                'lines': [('create', [{
+                                'operator': '+',
+                                'type': type_,
+                                'amount': amount,
+                                'tax': tax.id,
+                                } for type_ in ['invoice', 'credit']])],
+                }
+        base_code, tax_code = TaxCodeTemplate.create([
+                code('Base 21%', 'base'), code('Tax 21%', 'tax')])
+        for name, code in [
+                ('accrued_vat_base_3', base_code),
+                ('accrued_vat_tax_3', tax_code),
+                ]:
+            mapping, = MappingTemplate.search([
+                    ('aeat303_field.model.model', '=', 'aeat.303.report'),
+                    ('aeat303_field.name', '=', name),
+                    ])
+            MappingTemplate.write([mapping], {
+                    'code': [('add', [code.id])],
+                    })
+
+
+def create_moves(company, periods, moves, rng):
+    '''
+    Insert posted moves with their lines and tax lines in each period using
+    bulk inserts and return the number of tax lines
+    '''
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Tax = pool.get('account.tax')
+    Move = pool.get('account.move')
+    Line = pool.get('account.move.line')
+    TaxLine = pool.get('account.tax.line')
+    cursor = Transaction().connection.cursor()
+    move_table = Move.__table__()
+    line_table = Line.__table__()
+    tax_line_table = TaxLine.__table__()
+
+    tax, = Tax.search([('company', '=', company.id)], limit=1)
+    journal, = Journal.search([('code', '=', 'REV')])
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ])
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('party_required', '=', True),
+            ('company', '=', company.id),
+            ], limit=1)
+    tax_account = tax.invoice_account
+    # The moves are older than the snapshot margin to be stable
+    create_date = (datetime.datetime.now()
+        - pool.get('aeat.303.report')._snapshot_margin * 2)
+
+    prefix = 'AEAT303-%s-' % company.id
+    rows = []
+    for period in periods:
+        for i in range(moves):
+            number = '%s%s-%s' % (prefix, period.id, i)
+            rows.append([number, number, company.id, period.id, journal.id,
+                    period.start_date, period.start_date, 'posted', USER,
+                    create_date])
+    for sub_rows in grouped_slice(rows, BUCKET):
+        cursor.execute(*move_table.insert([
+                    move_table.number, move_table.post_number,
+                    move_table.company, move_table.period, move_table.journal,
+                    move_table.date, move_table.post_date, move_table.state,
+                    move_table.create_uid, move_table.create_date],
+                list(sub_rows)))
+    cursor.execute(*move_table.select(move_table.id,
+            where=move_table.number.like(prefix + '%'),
+            order_by=move_table.id))
+    move_ids = [i for i, in cursor]
+
+    amounts = {}
+    rows = []
+    for move_id in move_ids:
+        base = Decimal(rng.randint(100, 1000000)) / 100
+        if not rng.randrange(10):
+            base = -base
+        amount = (base * tax.rate).quantize(Decimal('0.01'))
+        amounts[move_id] = (base, amount)
+        for account, value, party in [
+                (revenue, base, None),
+                (tax_account, amount, None),
+                (receivable, -(base + amount), company.party.id),
+                ]:
+            rows.append([move_id, account.id, max(-value, 0),
+                    max(value, 0), party, 'valid', USER, create_date])
+    for sub_rows in grouped_slice(rows, BUCKET):
+        cursor.execute(*line_table.insert([
+                    line_table.move, line_table.account, line_table.debit,
+                    line_table.credit, line_table.party, line_table.state,
+                    line_table.create_uid, line_table.create_date],
+                list(sub_rows)))
+
+    rows = []
+    for sub_ids in grouped_slice(move_ids):
+        cursor.execute(*line_table.select(
+                line_table.id, line_table.move, line_table.account,
+                where=line_table.move.in_(list(sub_ids))
+                & line_table.account.in_([revenue.id, tax_account.id])))
+        for line_id, move_id, account_id in cursor.fetchall():
+            base, amount = amounts[move_id]
+            if account_id == revenue.id:
+                rows.append([line_id, tax.id, 'base', base, USER,
+                        create_date])
+            else:
+                rows.append([line_id, tax.id, 'tax', amount, USER,
+                        create_date])
+    for sub_rows in grouped_slice(rows, BUCKET):
+        cursor.execute(*tax_line_table.insert([
+                    tax_line_table.move_line, tax_line_table.tax,
+                    tax_line_table.type, tax_line_table.amount,
+                    tax_line_table.create_uid, tax_line_table.create_date],
+                list(sub_rows)))
+    return len(rows)
+
+
+def date_tax_code_lines(company, date):
+    "Date back the changes of the tax code lines of company to date"
+    pool = Pool()
+    TaxCode = pool.get('account.tax.code')
+    TaxCodeLine = pool.get('account.tax.code.line')
+    cursor = Transaction().connection.cursor()
+    code_table = TaxCode.__table__()
+    code_line_table = TaxCodeLine.__table__()
+
+    cursor.execute(*code_line_table.update(
+            [code_line_table.create_date, code_line_table.write_date],
+            [date, date],
+            where=code_line_table.code.in_(code_table.select(code_table.id,
+                    where=code_table.company == company.id))))
+
+
+def generate(companies, periods, moves, results, seed=0):
+    '''
+    Create the companies with their chart, fiscal year and the moves of
+    the first periods and return the monthly reports and the number of tax
+    lines.
+    The moves and the tax code lines are dated before the snapshot margin so
+    the snapshot of their tax lines can be used.
+    The creation of the chart is timed.
+    '''
+    pool = Pool()
+    FiscalYear = pool.get('account.fiscalyear')
+    Report = pool.get('aeat.303.report')
+    CreateChart = pool.get('account.create_chart', type='wizard')
+    rng = random.Random(seed)
+    date = datetime.datetime.now() - Report._snapshot_margin * 2
+
+    create_templates()
+    currency = create_currency('EUR')
+    reports, tax_lines, durations = [], 0, []
+    for i in range(companies):
+        company = create_company(name='Company %s' % i, currency=currency)
+        with set_company(company):
+            with timed(CreateChart, 'transition_create_account', durations):
+                create_chart(company)
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            fiscalyear_periods = fiscalyear.periods[:periods]
+            tax_lines += create_moves(
+                company, fiscalyear_periods, moves, rng)
+            date_tax_code_lines(company, date)
+            for period in fiscalyear_periods:
+                reports.append(Report(
+                        company=company,
+                        fiscalyear=fiscalyear,
+                        fiscalyear_code=fiscalyear.start_date.year,
+                        period='%02d' % period.start_date.month,
+                        type='I'))
+    Report.save(reports)
+
+    seconds = sum(durations)
+    results.append({
+            'name': 'CreateChart.transition_create_account',
+            'seconds': seconds,
+            'counts': {'companies': companies},
+            'rates': {'companies': companies / seconds},
+            })
+    return reports, tax_lines
+
+
+def run(companies, periods, moves):
+    "Generate the data, run the benchmarks and return their results"
+    pool = Pool()
+    Report = pool.get('aeat.303.report')
+    Account = pool.get('account.account')
+    UpdateChart = pool.get('account.update_chart', type='wizard')
+
+    results = []
+    reports, tax_lines = generate(companies, periods, moves, results)
+
+    with measure(results, 'calculate',
+            reports=len(reports), tax_lines=tax_lines):
+        Report.calculate(reports)
+    Report.draft(reports)
+    since = []
+    with measure(results, 'calculate (snapshot)',
+            reports=len(reports), tax_lines=tax_lines), \
+            spied(Report, 'get_snapshot_since', since):
+        Report.calculate(reports)
+    # Record the reports calculated from their snapshot
+    results[-1]['snapshots'] = len([s for s in since if s is not None])
+    with measure(results, 'create_file', reports=len(reports)):
+        for report in reports:
+            report.create_file()
+
+    wizards = []
+    for account in Account.search([('parent', '=', None)]):
+        session_id, _, _ = UpdateChart.create()
+        update_chart = UpdateChart(session_id)
+        update_chart.start.account = account
+        wizards.append(update_chart)
+    with measure(results, 'UpdateChart.transition_update',
+            companies=len(wizards)):
+        for update_chart in wizards:
+            with set_company(update_chart.start.account.company):
+                update_chart.transition_update()
+    return results
+
+
+def compare(results, previous):
+    "Return the ratio of the rates of results to the previous ones"
+    previous = {r['name']: r['rates'] for r in previous}
+    ratios = {}
+    for result in results:
+        rates = previous.get(result['name'], {})
+        ratios[result['name']] = {k: v / rates[k]
+            for k, v in result['rates'].items() if rates.get(k)}
+    return ratios
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--companies', type=int, default=2)
+    parser.add_argument('--periods', type=int, default=3,
+        choices=range(1, 13), metavar='[1-12]')
+    parser.add_argument('--moves', type=int, default=100,
+        help="number of moves per period and company")
+    parser.add_argument('--output', help="file to store the results as JSON")
+    parser.add_argument('--compare',
+        help="JSON file of a previous run to compare with")
+    options = parser.parse_args(arguments)
+
+    activate_module('aeat_303')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        try:
+            results = run(options.companies, options.periods, options.moves)
+        finally:
+            transaction.rollback()
+
+    data = {
+        'backend': backend.name,
+        'volumes': {
+            'companies': options.companies,
+            'periods': options.periods,
+            'moves': options.moves,
+            },
+        'results': results,
+        }
+    ratios = {}
+    if options.compare:
+        with open(options.compare) as fp:
+            ratios = compare(results, json.load(fp)['results'])
+    for result in results:
+        print('%-40s %10.3fs' % (result['name'], result['seconds']))
+        if 'snapshots' in result:
+            print('    %-36s %10d/%d' % ('snapshots', result['snapshots'],
+                    result['counts']['reports']))
+        for unit, rate in sorted(result['rates'].items()):
+            line = '    %-36s %10.1f/s' % (unit, rate)
+            if unit in ratios.get(result['name'], {}):
+                line += ' (x%.2f)' % ratios[result['name']][unit]
+            print(line)
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
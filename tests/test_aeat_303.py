@@ -1,18 +1,1376 @@
 # This file is part of the aeat_303 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import io
 import unittest
+import unicodedata
 import doctest
+import zipfile
+from datetime import datetime, timedelta
+from decimal import Decimal
+from unittest.mock import Mock, patch
+from retrofix import aeat303
+from retrofix.fields import Boolean, Char, Const, Number, Numeric
+from retrofix.record import Record, write as retrofix_write
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
+from trytond import backend
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.pool import Pool
+from trytond.pyson import PYSONDecoder
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.aeat_303.aeat import remove_accents, iter_files
+
+
+# Simplified file records that do not depend on the retrofix version
+FILE_RECORDS = [
+    ('header', (
+            (1, 4, 'fiscalyear', Number),
+            (5, 2, 'period', Char),
+            )),
+    ('record', (
+            (1, 9, 'company_vat', Char),
+            (10, 17, 'accrued_vat_base_3', Numeric),
+            (27, 1, 'type', Char),
+            (28, 1, 'bankruptcy', Boolean()),
+            )),
+    ('general', (
+            (1, 11, 'swift_bank', Char),
+            (12, 34, 'bank_account', Char),
+            )),
+    ('footer', (
+            (1, 4, 'footer', Const('</T>')),
+            )),
+    ]
+
+
+def create_move(company, period, base, amount):
+    "Create a move with tax lines, credit notes use negative amounts"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Tax = pool.get('account.tax')
+    Move = pool.get('account.move')
+
+    tax, = Tax.search([('company', '=', company.id)], limit=1)
+    journal, = Journal.search([('code', '=', 'REV')])
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('company', '=', company.id),
+            ])
+    receivable, = Account.search([
+            ('type.receivable', '=', True),
+            ('company', '=', company.id),
+            ])
+
+    def line(account, amount, **values):
+        values.update({
+                'account': account.id,
+                'credit': amount if amount > 0 else 0,
+                'debit': -amount if amount < 0 else 0,
+                })
+        return values
+
+    move, = Move.create([{
+                'period': period.id,
+                'journal': journal.id,
+                'date': period.start_date,
+                'lines': [('create', [
+                            line(revenue, base, tax_lines=[('create', [{
+                                                'amount': base,
+                                                'type': 'base',
+                                                'tax': tax.id,
+                                                }])]),
+                            line(tax.invoice_account, amount,
+                                tax_lines=[('create', [{
+                                                'amount': amount,
+                                                'type': 'tax',
+                                                'tax': tax.id,
+                                                }])]),
+                            line(receivable, -(base + amount),
+                                party=company.party.id),
+                            ])],
+                }])
+    return move
+
+
+def create_tax_codes(company):
+    "Create a small tax code tree and its moves for the first period"
+    pool = Pool()
+    FiscalYear = pool.get('account.fiscalyear')
+    Tax = pool.get('account.tax')
+    TaxCode = pool.get('account.tax.code')
+
+    fiscalyear = get_fiscalyear(company)
+    fiscalyear.save()
+    FiscalYear.create_period([fiscalyear])
+    create_chart(company, tax=True)
+
+    tax, = Tax.search([('company', '=', company.id)], limit=1)
+    parent, = TaxCode.create([{
+                'name': 'Total',
+                'company': company.id,
+                'childs': [('create', [{
+                                'name': 'Tax',
+                                'company': company.id,
+                                'lines': [('create', [{
+                                                'operator': '+',
+                                                'type': 'invoice',
+                                                'amount': 'tax',
+                                                'tax': tax.id,
+                                                }, {
+                                                'operator': '-',
+                                                'type': 'credit',
+                                                'amount': 'tax',
+                                                'tax': tax.id,
+                                                }])],
+                                }, {
+                                'name': 'Base',
+                                'company': company.id,
+                                'lines': [('create', [{
+                                                'operator': '+',
+                                                'type': 'invoice',
+                                                'amount': 'base',
+                                                'tax': tax.id,
+                                                }, {
+                                                'operator': '+',
+                                                'type': 'credit',
+                                                'amount': 'base',
+                                                'tax': tax.id,
+                                                }])],
+                                }])],
+                }])
+    tax_code, = [c for c in parent.childs if c.name == 'Tax']
+    base_code, = [c for c in parent.childs if c.name == 'Base']
+
+    period = fiscalyear.periods[0]
+    for base, amount in [
+            (Decimal('100.00'), Decimal('20.00')),
+            (Decimal('33.33'), Decimal('6.67')),
+            (Decimal('-10.00'), Decimal('-2.00')),
+            ]:
+        create_move(company, period, base, amount)
+    return fiscalyear, parent, tax_code, base_code
+
+
+def create_mapping(company, values):
+    "Create the code mappings of company from a field name to codes dict"
+    pool = Pool()
+    Mapping = pool.get('aeat.303.mapping')
+    Field = pool.get('ir.model.field')
+
+    return Mapping.create([{
+                'company': company.id,
+                'type_': 'code',
+                'aeat303_field': Field.search([
+                        ('model.model', '=', 'aeat.303.report'),
+                        ('name', '=', name),
+                        ])[0].id,
+                'code': [('add', [c.id for c in codes])],
+                } for name, codes in values.items()])
+
+
+def create_report(company, fiscalyear, period='01'):
+    pool = Pool()
+    Report = pool.get('aeat.303.report')
+
+    report = Report()
+    report.company = company
+    report.fiscalyear = fiscalyear
+    report.fiscalyear_code = fiscalyear.start_date.year
+    report.period = period
+    report.type = 'I'
+    report.save()
+    return report
+
+
+def create_code_templates(name):
+    '''
+    Create a tax code template for each code mapping template and return the
+    mapping templates
+    '''
+    pool = Pool()
+    AccountTemplate = pool.get('account.account.template')
+    TaxCodeTemplate = pool.get('account.tax.code.template')
+    MappingTemplate = pool.get('aeat.303.template.mapping')
+    ModelData = pool.get('ir.model.data')
+
+    template = AccountTemplate(ModelData.get_id(
+            'account', 'account_template_root_en'))
+    mapping_templates = MappingTemplate.search([
+            ('type_', '=', 'code'),
+            ])
+    with Transaction().set_user(0):
+        code_templates = TaxCodeTemplate.create([{
+                    'name': '%s %s' % (t.aeat303_field.name, name),
+                    'account': template.id,
+                    } for t in mapping_templates])
+        for mapping_template, code_template in zip(
+                mapping_templates, code_templates):
+            MappingTemplate.write([mapping_template], {
+                    'code': [('add', [code_template.id])],
+                    })
+    return mapping_templates
 
 
 class Aeat303TestCase(ModuleTestCase):
     'Test Aeat 303 module'
     module = 'aeat_303'
 
+    @with_transaction()
+    def test_calculate(self):
+        'Test calculate gives the amounts of the tax codes'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        TaxCode = pool.get('account.tax.code')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear, parent, tax_code, base_code = create_tax_codes(
+                company)
+            create_mapping(company, {
+                    'accrued_vat_base_3': [base_code],
+                    'accrued_vat_tax_3': [tax_code],
+                    'accrued_vat_tax_1': [parent],
+                    })
+            report = create_report(company, fiscalyear)
+
+            Report.calculate([report])
+
+            periods = [fiscalyear.periods[0].id]
+            with Transaction().set_context(periods=periods):
+                parent, tax_code, base_code = TaxCode.browse(
+                    [parent, tax_code, base_code])
+                self.assertEqual(report.accrued_vat_base_3, base_code.amount)
+                self.assertEqual(report.accrued_vat_tax_3, tax_code.amount)
+                self.assertEqual(report.accrued_vat_tax_1, parent.amount)
+            self.assertEqual(report.accrued_vat_base_3, Decimal('143.33'))
+            self.assertEqual(report.accrued_vat_tax_3, Decimal('24.67'))
+            self.assertEqual(report.accrued_vat_tax_1, Decimal('168.00'))
+            self.assertEqual(report.state, 'calculated')
+
+    @with_transaction()
+    def test_calculate_lines(self):
+        'Test calculate keeps the amount of each box and tax code'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        TaxLine = pool.get('account.tax.line')
+        MoveLine = pool.get('account.move.line')
+        OpenTaxLines = pool.get(
+            'aeat.303.report.line.open_tax_lines', type='wizard')
+        OpenMoveLines = pool.get(
+            'aeat.303.report.line.open_move_lines', type='wizard')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear, parent, tax_code, base_code = create_tax_codes(
+                company)
+            create_mapping(company, {
+                    'accrued_vat_base_3': [base_code],
+                    'accrued_vat_tax_3': [tax_code],
+                    'accrued_vat_tax_1': [parent],
+                    })
+            report = create_report(company, fiscalyear)
+
+            Report.calculate([report])
+            Report.draft([report])
+            Report.calculate([report])
+
+            self.assertEqual(sorted((l.aeat303_field.name, l.code, l.amount)
+                    for l in report.lines), [
+                    ('accrued_vat_base_3', base_code, Decimal('143.33')),
+                    ('accrued_vat_tax_1', parent, Decimal('168.00')),
+                    ('accrued_vat_tax_3', tax_code, Decimal('24.67')),
+                    ])
+
+            def open_(Wizard, line):
+                session_id, _, _ = Wizard.create()
+                with Transaction().set_context(
+                        active_model='aeat.303.report.line',
+                        active_id=line.id, active_ids=[line.id]):
+                    action, _ = Wizard(session_id).do_open_({'name': 'Lines'})
+                return PYSONDecoder().decode(action['pyson_domain'])
+
+            for line in report.lines:
+                domain = open_(OpenTaxLines, line)
+                tax_lines = TaxLine.search(domain)
+                self.assertEqual(len(TaxLine.search(domain, limit=2)), 2)
+                self.assertEqual(len(MoveLine.search(
+                            open_(OpenMoveLines, line))), len(tax_lines))
+                if line.code == tax_code:
+                    self.assertEqual(len(tax_lines), 3)
+                elif line.code == parent:
+                    self.assertEqual(len(tax_lines), 6)
+
+    @with_transaction()
+    def test_tax_code_closure(self):
+        'Test the closure of the tax codes follows the tree'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        TaxCode = pool.get('account.tax.code')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear, parent, tax_code, base_code = create_tax_codes(
+                company)
+            self.assertEqual(Report.get_tax_code_closure([parent]), {
+                    parent.id: tuple(sorted([
+                                (tax_code.id, parent.id),
+                                (base_code.id, parent.id),
+                                ])),
+                    })
+
+            child, = TaxCode.create([{
+                        'name': 'Child',
+                        'company': company.id,
+                        'parent': tax_code.id,
+                        }])
+            closure = Report.get_tax_code_closure([parent, tax_code])
+            self.assertEqual(closure[parent.id][-1], (child.id, tax_code.id))
+            self.assertEqual(closure[tax_code.id], ((child.id, tax_code.id),))
+
+            # An inactive code is not summed to its parents
+            TaxCode.write([base_code], {
+                    'end_date': fiscalyear.start_date - timedelta(days=1),
+                    })
+            periods = [fiscalyear.periods[0].id]
+            amounts, = Report.get_tax_code_amounts([parent], [periods])
+            with Transaction().set_context(periods=periods):
+                parent = TaxCode(parent.id)
+                self.assertEqual(amounts[parent.id], parent.amount)
+            self.assertEqual(amounts[parent.id], Decimal('24.67'))
+
+    @with_transaction()
+    def test_calculate_timings(self):
+        'Test calculate records the timings of its phases'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear, _, tax_code, base_code = create_tax_codes(company)
+            create_mapping(company, {
+                    'accrued_vat_base_3': [base_code],
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+            report = create_report(company, fiscalyear)
+
+            with patch.object(Report, 'log_timings') as log_timings:
+                Report.calculate([report])
+
+            timings = report.timings['calculate']
+            self.assertEqual(timings['reports'], 1)
+            self.assertEqual(timings['rows'], 6)
+            self.assertTrue({'periods', 'mapping', 'codes', 'snapshot',
+                    'aggregation', 'boxes', 'save'} <= set(timings))
+            log_timings.assert_called_once_with(
+                'calculate', [report], timings)
+
+    @with_transaction()
+    def test_calculate_batch(self):
+        'Test calculate many reports sharing periods'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear, _, tax_code, base_code = create_tax_codes(company)
+            create_mapping(company, {
+                    'accrued_vat_base_3': [base_code],
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+            reports = [create_report(company, fiscalyear, period)
+                for period in ['01', '1T', '01', '02']]
+
+            Report.calculate(reports)
+
+            self.assertEqual(
+                [(r.accrued_vat_base_3, r.accrued_vat_tax_3)
+                    for r in reports],
+                [(Decimal('143.33'), Decimal('24.67'))] * 3
+                + [(Decimal('0.0'), Decimal('0.0'))])
+            self.assertEqual(
+                len({r.calculation_date for r in reports}), 1)
+
+    @with_transaction()
+    def test_calculate_snapshot(self):
+        'Test recalculate from snapshot'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        Move = pool.get('account.move')
+        cursor = Transaction().connection.cursor()
+        move_table = Move.__table__()
+
+        company = create_company(currency=create_currency('EUR'))
+        # The snapshot includes the lines created in the same second
+        with set_company(company), \
+                patch.object(Report, '_snapshot_margin',
+                    timedelta(seconds=-1)):
+            fiscalyear, _, tax_code, base_code = create_tax_codes(company)
+            Move.post(Move.search([]))
+            create_mapping(company, {
+                    'accrued_vat_base_3': [base_code],
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+            report = create_report(company, fiscalyear)
+
+            Report.calculate([report])
+            snapshot = report.snapshot
+            self.assertEqual(snapshot['totals'][str(tax_code.id)],
+                Decimal('24.67'))
+
+            # A late move posted after the snapshot in the same period and a
+            # draft one
+            period = fiscalyear.periods[0]
+            move = create_move(
+                company, period, Decimal('50.00'), Decimal('10.00'))
+            Move.post([move])
+            cursor.execute(*move_table.update(
+                    [move_table.create_date, move_table.write_date],
+                    [datetime.now() + timedelta(minutes=1), None],
+                    where=move_table.id == move.id))
+            create_move(company, period, Decimal('-5.00'), Decimal('-1.00'))
+            Report.draft([report])
+            childs, = Report.get_tax_code_childs(
+                [base_code, tax_code], [[period.id]])
+            changes, lines = Report.get_tax_code_changes(childs)
+            self.assertEqual(
+                report.get_snapshot_since([period.id], childs, changes, lines),
+                report.snapshot_date)
+            Report.calculate([report])
+
+            self.assertEqual(report.accrued_vat_base_3, Decimal('198.33'))
+            self.assertEqual(report.accrued_vat_tax_3, Decimal('33.67'))
+            self.assertEqual(report.snapshot['totals'], snapshot['totals'])
+
+            # Full recomputation gives the same result
+            Report.draft([report])
+            Report.write([report], {'snapshot': None})
+            Report.calculate([report])
+            self.assertEqual(report.accrued_vat_base_3, Decimal('198.33'))
+            self.assertEqual(report.accrued_vat_tax_3, Decimal('33.67'))
+
+    @with_transaction()
+    def test_calculate_snapshot_changes(self):
+        'Test recalculate from snapshot after changes of its lines'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        Move = pool.get('account.move')
+        TaxLine = pool.get('account.tax.line')
+        TaxCodeLine = pool.get('account.tax.code.line')
+
+        def recalculate(report):
+            "Recalculate report and check it matches a full recomputation"
+            Report.draft([report])
+            Report.calculate([report])
+            amount = report.accrued_vat_tax_3
+            Report.draft([report])
+            Report.write([report], {'snapshot': None})
+            Report.calculate([report])
+            self.assertEqual(report.accrued_vat_tax_3, amount)
+            return amount
+
+        company = create_company(currency=create_currency('EUR'))
+        # The snapshot includes the lines created in the same second
+        with set_company(company), \
+                patch.object(Report, '_snapshot_margin',
+                    timedelta(seconds=-1)):
+            fiscalyear, _, tax_code, base_code = create_tax_codes(company)
+            Move.post(Move.search([]))
+            create_mapping(company, {
+                    'accrued_vat_base_3': [base_code],
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+            report = create_report(company, fiscalyear)
+
+            Report.calculate([report])
+            self.assertEqual(report.accrued_vat_tax_3, Decimal('24.67'))
+
+            # The tax lines of a posted move of an open period can change
+            tax_line, = TaxLine.search([
+                    ('type', '=', 'tax'),
+                    ('amount', '=', Decimal('20.00')),
+                    ])
+            TaxLine.write([tax_line], {'amount': Decimal('30.00')})
+            self.assertIsNone(Report(report.id).snapshot_date)
+            self.assertEqual(recalculate(report), Decimal('34.67'))
+
+            tax_line, = TaxLine.search([
+                    ('type', '=', 'tax'),
+                    ('amount', '=', Decimal('6.67')),
+                    ])
+            TaxLine.delete([tax_line])
+            self.assertEqual(recalculate(report), Decimal('28.00'))
+
+            # A code line deleted does not change the last date of the others
+            code_line, = TaxCodeLine.search([
+                    ('code', '=', tax_code.id),
+                    ('type', '=', 'credit'),
+                    ])
+            TaxCodeLine.delete([code_line])
+            self.assertEqual(recalculate(report), Decimal('30.00'))
+
+            # The posted moves can still be written through their lines
+            self.assertTrue(Report(report.id).snapshot_date)
+            Move.write(Move.search([], limit=1), {'lines': []})
+            self.assertIsNone(Report(report.id).snapshot_date)
+
+    @with_transaction()
+    def test_calculate_by_company(self):
+        'Test calculate the reports of each company in a process'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        Queue = pool.get('ir.queue')
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        other = create_company(name='Other', currency=currency)
+        reports = []
+        for company_ in [company, other]:
+            with set_company(company_):
+                fiscalyear, _, tax_code, _ = create_tax_codes(company_)
+                create_mapping(company_, {
+                        'accrued_vat_tax_3': [tax_code],
+                        })
+                reports.extend(create_report(company_, fiscalyear, period)
+                    for period in ['01', '02'])
+
+        calls = []
+
+        class ProcessPool(object):
+            "Run the tasks in the current process"
+            def __init__(self, processes, initializer, initargs):
+                calls.append(processes)
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+            def starmap(self, func, args):
+                calls.extend(a[-1] for a in args)
+                return [func(*a) for a in args]
+
+        calculate = Report.calculate
+
+        def fail_other(reports):
+            "Make the calculation of the reports of other fail"
+            if any(r.company == other for r in reports):
+                raise UserError('Calculation failed')
+            return calculate(reports)
+
+        mp_context = Mock(Pool=ProcessPool)
+        with patch.object(config, 'getboolean', return_value=True), \
+                patch('multiprocessing.get_context',
+                    return_value=mp_context), \
+                patch.object(Report, 'calculate', side_effect=fail_other), \
+                patch.object(Transaction, 'commit'), \
+                patch.object(Transaction, 'rollback'):
+            errors = Report.calculate_by_company(
+                list(reversed(reports)), processes=4)
+
+        self.assertEqual(calls, [2,
+                [r.id for r in reports[:2]], [r.id for r in reports[2:]]])
+        self.assertEqual(list(errors), [company.id, other.id])
+        self.assertIsNone(errors[company.id])
+        self.assertTrue(errors[other.id])
+        # The processes do not push the reports to the queue
+        self.assertEqual(Queue.search([]), [])
+        self.assertEqual([r.state for r in Report.browse(reports)],
+            ['calculated', 'calculated', 'draft', 'draft'])
+        self.assertEqual(
+            Report(reports[0].id).accrued_vat_tax_3, Decimal('24.67'))
+
+    @with_transaction()
+    def test_calculate_queue(self):
+        'Test calculate from the queue'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        Queue = pool.get('ir.queue')
+        transaction = Transaction()
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        other = create_company(name='Other', currency=currency)
+        reports = []
+        for company_ in [company, other]:
+            with set_company(company_):
+                fiscalyear, _, tax_code, _ = create_tax_codes(company_)
+                create_mapping(company_, {
+                        'accrued_vat_tax_3': [tax_code],
+                        })
+                reports.extend(create_report(company_, fiscalyear, period)
+                    for period in ['01', '02', '03'])
+
+        with patch.object(config, 'getboolean', return_value=True), \
+                patch.object(config, 'getint', return_value=2):
+            Report.calculate(reports)
+        self.assertEqual({r.queue_state for r in reports}, {'queued'})
+        self.assertEqual({r.state for r in reports}, {'draft'})
+        tasks = Queue.search([])
+        self.assertEqual(
+            [len(t.data['instances']) for t in tasks], [2, 1, 2, 1])
+
+        with patch.object(transaction, 'commit'):
+            for task in tasks:
+                task.run()
+        self.assertEqual({r.queue_state for r in reports}, {None})
+        self.assertEqual({r.state for r in reports}, {'calculated'})
+        self.assertEqual(reports[0].accrued_vat_tax_3, Decimal('24.67'))
+
+    @with_transaction()
+    def test_file_columns(self):
+        'Test the fields are routed to the file records containing them'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        with patch.object(Report, 'get_file_records', return_value=[
+                    ('header', aeat303.HEADER_RECORD),
+                    ('footer', aeat303.FOOTER_RECORD),
+                    ]):
+            columns = dict(Report.get_file_columns())
+        self.assertEqual(columns['period'], ('header', 'footer'))
+        self.assertNotIn('company', columns)
+        self.assertNotIn('bank_account', columns)
+
+    @with_transaction()
+    def test_write_zip(self):
+        'Test the files of the reports are written in a ZIP archive'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear, _, tax_code, _ = create_tax_codes(company)
+            create_mapping(company, {
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+            reports = [create_report(company, fiscalyear, period)
+                for period in ['01', '01', '02']]
+            Report.calculate(reports[:2])
+            Report.write(reports[:1], {'file_': b'first'})
+            Report.write(reports[1:2], {'file_': b'second'})
+
+            with patch.object(Report, 'create_file') as create_file, \
+                    patch.object(Report, 'read', wraps=Report.read) as read:
+                fileobj = io.BytesIO()
+                Report.write_zip(reports, fileobj)
+            create_file.assert_not_called()
+            # The files are read one by one
+            self.assertEqual(
+                [len(c[0][0]) for c in read.call_args_list
+                    if 'file_' in c[0][1]], [1, 1])
+
+            year = fiscalyear.start_date.year
+            with zipfile.ZipFile(fileobj) as archive:
+                self.assertEqual(archive.namelist(), [
+                        '%s/aeat303-%s-01.txt' % (company.id, year),
+                        '%s/aeat303-%s-01.txt-%s' % (
+                            company.id, year, reports[1].id),
+                        ])
+                self.assertEqual(archive.read(archive.namelist()[1]),
+                    b'second')
+
+            # The files are stored in the filestore
+            self.assertTrue(reports[0].file_id)
+            cursor = Transaction().connection.cursor()
+            table = Report.__table__()
+            cursor.execute(*table.select(table.file_,
+                    where=table.id == reports[0].id))
+            self.assertEqual(cursor.fetchone(), (None,))
+            with Transaction().set_context(
+                    {'aeat.303.report.file_': 'size'}):
+                self.assertEqual(Report(reports[1].id).file_, 6)
+
+            Report.draft(reports[:1])
+            self.assertIsNone(reports[0].file_)
+            self.assertIsNone(reports[0].file_id)
+
+    def test_remove_accents(self):
+        'Test remove accents gives the same result as normalizing'
+        def normalize(text):
+            text = ''.join(c for c in unicodedata.normalize('NFD', text)
+                if unicodedata.category(c) != 'Mn')
+            return unicodedata.normalize('NFC', text)
+
+        corpus = [
+            'Compañía Española de Transportes, S.L.',
+            'Àlex Güell i Puigcerdà',
+            'Plaça de la Constitució, 1 - A Coruña',
+            'Cafe\u0301 Pi\u0303a',
+            'ß ª º æ Ø œ Ŀ ŉ ǅ',
+            ''.join(chr(c) for c in range(0x20, 0xd800)),
+            ]
+        self.assertEqual(remove_accents(corpus),
+            [normalize(t) for t in corpus])
+        self.assertEqual(remove_accents(corpus, upper=True),
+            [normalize(t).upper() for t in corpus])
+        self.assertEqual(remove_accents('Ñandú', upper=True), 'NANDU')
+        self.assertEqual(remove_accents('Ñandú'.encode('iso-8859-1')),
+            'Nandu')
+
+    @with_transaction()
+    def test_import_files(self):
+        'Test import files as done reports'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        def create_file(year, period, amount, type_='I'):
+            records = [Record(l) for _, l in FILE_RECORDS]
+            records[0].fiscalyear = str(year)
+            records[0].period = period
+            records[1].company_vat = '00000000T'
+            records[1].accrued_vat_base_3 = amount
+            records[1].type = type_
+            return retrofix_write(records, separator='').encode('iso-8859-1')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            year = fiscalyear.start_date.year
+
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                zip_file.writestr('a.txt',
+                    create_file(year, '01', Decimal('143.33')))
+                zip_file.writestr('b.txt', b'garbage')
+                zip_file.writestr('c.txt',
+                    create_file(year - 1, '1T', Decimal('10')))
+                # A file that parses but is not a valid report
+                zip_file.writestr('d.txt',
+                    create_file(year, '02', Decimal('10'), type_='Z'))
+
+            transaction = Transaction()
+            with patch.object(Report, 'get_file_records',
+                        return_value=FILE_RECORDS), \
+                    patch.object(Report, '_file_columns', None), \
+                    patch.object(transaction, 'commit'), \
+                    patch.object(transaction, 'rollback') as rollback:
+                reports, rejected = Report.import_files(
+                    iter_files(archive), company, batch=2)
+
+            self.assertEqual([n for n, _ in rejected], ['b.txt', 'd.txt'])
+            # The second batch is rolled back and then d.txt alone
+            self.assertEqual(rollback.call_count, 2)
+            self.assertEqual(
+                [(r.fiscalyear, r.fiscalyear_code, r.period, r.state,
+                        r.company_vat, r.accrued_vat_base_3)
+                    for r in reports], [
+                    (fiscalyear, year, '01', 'done', '00000000T',
+                        Decimal('143.33')),
+                    (None, year - 1, '1T', 'done', '00000000T',
+                        Decimal('10')),
+                    ])
+            self.assertEqual(
+                reports[0].file_, create_file(year, '01', Decimal('143.33')))
+
+            # The imported files are kept while the values do not change
+            self.assertTrue(all(r.file_hash for r in reports))
+            with patch.object(Report, 'get_file_records',
+                        return_value=FILE_RECORDS), \
+                    patch.object(Report, '_file_columns', None):
+                self.assertEqual(Report.regenerate(reports), {})
+            self.assertEqual(
+                reports[0].file_, create_file(year, '01', Decimal('143.33')))
+
+            # The files imported without their values are kept
+            Report.write(reports, {'file_values': None})
+            with patch.object(Report, 'create_file') as create_file_:
+                self.assertEqual(Report.regenerate(reports), {})
+            create_file_.assert_not_called()
+
+    @with_transaction()
+    def test_parse_file(self):
+        'Test the created files are parsed back to the same values'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        # The records of the installed retrofix
+        records = [(n, getattr(aeat303, a)) for n, a in [
+                ('header', 'HEADER_RECORD'),
+                ('record', 'RECORD'),
+                ('general', 'GENERAL_RECORD'),
+                ('additional', 'ADDITIONAL_RECORD'),
+                ('footer', 'FOOTER_RECORD'),
+                ] if hasattr(aeat303, a)]
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company), \
+                patch.object(Report, 'get_file_records',
+                    return_value=records), \
+                patch.object(Report, '_file_columns', None):
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            # The second report has a date and leaves other columns blank
+            for period, date in [
+                    ('01', None),
+                    ('12', fiscalyear.start_date),
+                    ]:
+                report = create_report(company, fiscalyear, period)
+                Report.write([report], {
+                        'state': 'done',
+                        'accrued_vat_base_3': Decimal('100.00'),
+                        'accrued_vat_tax_3': Decimal('21.00'),
+                        'auto_bankruptcy_date': date,
+                        })
+                report.create_file()
+
+                values = Report.parse_file(report.file_)
+                self.assertEqual(values['fiscalyear_code'],
+                    fiscalyear.start_date.year)
+                self.assertEqual(values['period'], period)
+                self.assertEqual(values['type'], 'I')
+                self.assertEqual(
+                    values['accrued_vat_base_3'], Decimal('100.00'))
+                self.assertEqual(
+                    values['accrued_vat_tax_3'], Decimal('21.00'))
+                if 'auto_bankruptcy_date' in values:
+                    self.assertEqual(values['auto_bankruptcy_date'], date)
+
+    @with_transaction()
+    def test_create_file_hash(self):
+        'Test create file is skipped when the exported values are the same'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            report = create_report(company, fiscalyear)
+            Report.write([report], {
+                    'state': 'done',
+                    'accrued_vat_base_3': Decimal('100.00'),
+                    })
+
+            with patch.object(Report, 'get_file_records',
+                        return_value=FILE_RECORDS), \
+                    patch.object(Report, '_file_columns', None):
+                self.assertIn('accrued_vat_base_3', report.create_file())
+                file_id = report.file_id
+                self.assertTrue(file_id)
+                self.assertTrue(report.file_hash)
+
+                with patch.object(Report, 'save') as save:
+                    self.assertIsNone(report.create_file())
+                    self.assertEqual(Report.regenerate([report]), {})
+                save.assert_not_called()
+
+                Report.write([report], {
+                        'accrued_vat_base_3': Decimal('150.00'),
+                        })
+                self.assertEqual(Report.regenerate([report]), {
+                        report: ['accrued_vat_base_3'],
+                        })
+                self.assertNotEqual(report.file_id, file_id)
+                self.assertEqual(
+                    report.file_values['accrued_vat_base_3'], '150.00')
+
+    @with_transaction()
+    def test_totals(self):
+        'Test the totals computed from the amounts'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            report, empty = [
+                create_report(company, fiscalyear, p) for p in ['01', '02']]
+            Report.write([report], {
+                    'accrued_vat_tax_1': Decimal('10.00'),
+                    'accrued_re_tax_3': Decimal('2.50'),
+                    'deductible_current_domestic_operations_tax': (
+                        Decimal('4.00')),
+                    'deductible_compensations': Decimal('1.50'),
+                    'state_administration_percent': Decimal('50.00'),
+                    'result_tax_regularitzation': Decimal('3.00'),
+                    'previous_period_pending_amount_to_compensate': (
+                        Decimal('6.00')),
+                    'previous_period_amount_to_compensate': Decimal('1.00'),
+                    'aduana_tax_pending': Decimal('0.75'),
+                    'to_deduce': Decimal('2.00'),
+                    })
+
+            report, empty = Report.browse([report, empty])
+            self.assertEqual(report.accrued_total_tax, Decimal('12.50'))
+            self.assertEqual(report.deductible_total, Decimal('5.50'))
+            self.assertEqual(report.general_regime_result, Decimal('7.00'))
+            self.assertEqual(
+                report.state_administration_amount, Decimal('3.50'))
+            self.assertEqual(
+                report.result_previous_period_amount_to_compensate,
+                Decimal('5.00'))
+            self.assertEqual(report.sum_results, Decimal('10.00'))
+            self.assertEqual(report.result, Decimal('3.25'))
+            self.assertEqual(report.liquidation_result, Decimal('1.25'))
+            self.assertEqual(empty.result, Decimal('0'))
+            self.assertEqual(empty.liquidation_result, Decimal('0'))
+
+            self.assertEqual(Report.search([
+                        ('result', '>', Decimal('3.00')),
+                        ]), [report])
+            self.assertEqual(Report.search([], order=[
+                        ('liquidation_result', 'ASC'),
+                        ]), [empty, report])
+
+            Report.write([report], {
+                    'to_deduce': Decimal('4.00'),
+                    })
+            self.assertEqual(report.liquidation_result, Decimal('-0.75'))
+            self.assertEqual(Report.search([
+                        ('liquidation_result', '<', 0),
+                        ]), [report])
+
+    @with_transaction()
+    def test_company_fields(self):
+        'Test the company fields are computed once by company'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        Company = pool.get('company.company')
+        Party = pool.get('party.party')
+        transaction = Transaction()
+
+        currency = create_currency('EUR')
+        reports = []
+        for name in ['Company 1', 'Company 2']:
+            company = create_company(name=name, currency=currency)
+            with set_company(company):
+                fiscalyear = get_fiscalyear(company)
+                fiscalyear.save()
+                reports.append([
+                        create_report(company, fiscalyear, '%02d' % month)
+                        for month in range(1, 13)])
+
+        def count_reads(report_ids):
+            transaction.cache.clear()
+            with patch.object(Company, 'read', wraps=Company.read) as read, \
+                    patch.object(Party, 'read', wraps=Party.read) as p_read:
+                reports = Report.browse(report_ids)
+                Report.validate(reports)
+                parties = {r.id: r.company_party for r in reports}
+                return read.call_count + p_read.call_count, parties
+
+        few = [reports[0][0].id, reports[1][0].id]
+        many = [r.id for r in reports[0] + reports[1]]
+        few_count, few_parties = count_reads(few)
+        many_count, many_parties = count_reads(many)
+        self.assertEqual(few_count, many_count)
+        self.assertLessEqual(many_count, len(reports))
+        self.assertEqual(many_parties, {
+                r.id: r.company.party for r in reports[0] + reports[1]})
+
+        company = reports[0][0].company
+        report = Report(company=company)
+        self.assertEqual(report.on_change_with_company_name(),
+            company.party.name.upper())
+        self.assertEqual(report.on_change_with_company_vat(), None)
+
+        # The defaults are the values on change of the company
+        with set_company(company):
+            self.assertEqual(Report.default_company_party(), company.party.id)
+            self.assertEqual(Report.default_company_name(),
+                company.party.name.upper())
+            self.assertEqual(Report.default_company_vat(), None)
+            for code, vat, default in [
+                    ('ES00000000T', '00000000T', '00000000T'),
+                    ('FR40303265045', None, 'FR40303265045'),
+                    ]:
+                Party.write([company.party], {
+                        'identifiers': [
+                            ('delete', [
+                                    i.id for i in company.party.identifiers]),
+                            ('create', [{'type': 'eu_vat', 'code': code}]),
+                            ],
+                        })
+                company = Company(company.id)
+                report = Report(company=company)
+                self.assertEqual(report.on_change_with_company_vat(), vat)
+                self.assertEqual(Report.default_company_vat(), default)
+
+    @with_transaction()
+    def test_update_chart(self):
+        'Test update chart maps the tax codes with a bounded number of queries'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Account = pool.get('account.account')
+        UpdateChart = pool.get('account.update_chart', type='wizard')
+        transaction = Transaction()
+
+        if backend.name != 'sqlite':
+            self.skipTest('Queries are traced only on SQLite')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            mapping_templates = create_code_templates('1')
+            create_chart(company)
+            create_code_templates('2')
+
+            session_id, _, _ = UpdateChart.create()
+            update_chart = UpdateChart(session_id)
+            update_chart.start.account, = Account.search([
+                    ('parent', '=', None),
+                    ('company', '=', company.id),
+                    ])
+            queries = []
+            connection = transaction.connection
+            connection.set_trace_callback(queries.append)
+            try:
+                update_chart.transition_update()
+            finally:
+                connection.set_trace_callback(None)
+
+            mappings = Mapping.search([
+                    ('company', '=', company.id),
+                    ('template', 'in', [t.id for t in mapping_templates]),
+                    ])
+            self.assertEqual(len(mappings), len(mapping_templates))
+            for mapping in mappings:
+                self.assertEqual(len(mapping.code), 2)
+                self.assertEqual({c.template for c in mapping.code},
+                    set(mapping.template.code))
+            # Only the new tax codes and relations are inserted one by one
+            self.assertLess(len(queries), 2 * len(mapping_templates) + 120)
+
+    @with_transaction()
+    def test_diff_templates(self):
+        'Test the dry run of the mapping updates'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            create_code_templates('1')
+            create_chart(company)
+            self.assertEqual(Mapping.diff_templates([company]), {})
+
+            mapping, = Mapping.search([
+                    ('company', '=', company.id),
+                    ('aeat303_field.name', '=', 'accrued_vat_tax_1'),
+                    ])
+            code, = mapping.code
+            Mapping.write([mapping], {
+                    'number': Decimal('1'),
+                    })
+            Relation.delete(Relation.search([
+                        ('mapping', '=', mapping.id),
+                        ]))
+            other, = Mapping.search([
+                    ('company', '=', company.id),
+                    ('aeat303_field.name', '=', 'accrued_vat_tax_2'),
+                    ])
+            other_code, = other.code
+            Relation.delete(Relation.search([
+                        ('mapping', '=', other.id),
+                        ]))
+            Mapping.delete([other])
+
+            self.assertEqual(Mapping.diff_templates([company]), {
+                    company.id: {
+                        'accrued_vat_tax_1': {
+                            'create': False,
+                            'add': [code.id],
+                            'remove': [],
+                            'values': ['number'],
+                            },
+                        'accrued_vat_tax_2': {
+                            'create': True,
+                            'add': [other_code.id],
+                            'remove': [],
+                            'values': [],
+                            },
+                        },
+                    })
+            self.assertEqual(Mapping(mapping.id).code, ())
+
+            Mapping.update_from_templates([company])
+            self.assertEqual(Mapping.diff_templates([company]), {})
+
+    @with_transaction()
+    def test_create_from_templates(self):
+        'Test the mappings are created from the templates for many companies'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        MappingTemplate = pool.get('aeat.303.template.mapping')
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+        TaxCode = pool.get('account.tax.code')
+
+        mapping_templates = create_code_templates('1')
+        currency = create_currency('EUR')
+        companies = []
+        for name in ['Company 1', 'Company 2']:
+            company = create_company(name=name, currency=currency)
+            with set_company(company):
+                create_chart(company)
+            companies.append(company)
+
+        self.assertEqual(Mapping.create_from_templates(companies), [])
+        mappings = Mapping.search([
+                ('company', 'in', [c.id for c in companies]),
+                ])
+        Relation.delete(Relation.search([
+                    ('mapping', 'in', [m.id for m in mappings]),
+                    ]))
+        Mapping.delete(mappings)
+
+        mappings = Mapping.create_from_templates(companies)
+        self.assertEqual(len(mappings), 2 * len(MappingTemplate.search([])))
+        for mapping in mappings:
+            if mapping.template in mapping_templates:
+                code, = mapping.code
+                self.assertEqual(code.company, mapping.company)
+                self.assertEqual(code.template, mapping.template.code[0])
+            else:
+                self.assertEqual(mapping.code, ())
+        self.assertEqual(len(TaxCode.search([])), len(
+                [m for m in mappings if m.code]))
+
+    @with_transaction()
+    def test_mapping_integrity(self):
+        'Test the integrity problems of the mappings'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        other_company = create_company(name='Other', currency=currency)
+        with set_company(other_company):
+            _, _, other_code, _ = create_tax_codes(other_company)
+        with set_company(company):
+            _, _, tax_code, base_code = create_tax_codes(company)
+            # The problems are saved as they were before the validation
+            with patch.object(Mapping, 'check_mappings_integrity'):
+                mappings = create_mapping(company, {
+                        'accrued_vat_base_1': [base_code],
+                        'accrued_vat_tax_1': [tax_code],
+                        'accrued_vat_tax_2': [tax_code],
+                        'accrued_vat_tax_3': [tax_code],
+                        })
+            self.assertEqual(Mapping.get_integrity_problems([company]), [
+                    ('duplicated', company.id,
+                        [m.id for m in mappings[1:]], [tax_code.id]),
+                    ])
+
+            Relation.delete(Relation.search([
+                        ('mapping', 'in', [m.id for m in mappings[2:]]),
+                        ]))
+            with patch.object(Mapping, 'check_mappings_integrity'):
+                Relation.create([{
+                            'mapping': mappings[3].id,
+                            'code': other_code.id,
+                            }])
+            self.assertEqual(Mapping.get_integrity_problems([company]), [
+                    ('empty', company.id, [mappings[2].id], []),
+                    ('company', company.id, [mappings[3].id],
+                        [other_code.id]),
+                    ])
+            self.assertEqual(Mapping.get_integrity_problems([other_company]),
+                [])
+            self.assertEqual(len(Mapping.get_integrity_problems()), 2)
+            self.assertEqual(
+                len(Mapping.get_integrity_messages([company])), 2)
+            Mapping.check_integrity_cron()
+
+            # Only the problems of the mappings written prevent saving them
+            Mapping.write(mappings[:2], {'template': None})
+            with self.assertRaises(UserError):
+                Mapping.write(mappings[3:], {'template': None})
+            with self.assertRaises(UserError):
+                Relation.create([{
+                            'mapping': mappings[0].id,
+                            'code': tax_code.id,
+                            }])
+
+    @with_transaction()
+    def test_mapping_integrity_fallback(self):
+        'Test the integrity problems with the mappings without company'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+        Field = pool.get('ir.model.field')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            _, _, tax_code, base_code = create_tax_codes(company)
+            mapping, = create_mapping(company, {
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+            # The problems are saved as they were before the validation
+            with patch.object(Mapping, 'check_mappings_integrity'):
+                fallbacks = Mapping.create([{
+                            'company': None,
+                            'type_': 'code',
+                            'aeat303_field': Field.search([
+                                    ('model.model', '=', 'aeat.303.report'),
+                                    ('name', '=', name),
+                                    ])[0].id,
+                            'code': [('add', [c.id for c in codes])],
+                            } for name, codes in [
+                            ('accrued_vat_tax_2', [tax_code]),
+                            ('accrued_vat_tax_3', [base_code]),
+                            ('accrued_vat_base_3', [base_code]),
+                            ]])
+
+            # The tax code is mapped to two fields by the company and by a
+            # mapping without company while the replaced one is ignored
+            problems = [('duplicated', company.id,
+                    sorted([mapping.id, fallbacks[0].id]), [tax_code.id])]
+            self.assertEqual(
+                Mapping.get_integrity_problems([company]), problems)
+            # Only the mappings without company are used for the others
+            self.assertEqual(Mapping.get_integrity_problems(), [
+                    ('duplicated', None,
+                        [f.id for f in fallbacks[1:]], [base_code.id]),
+                    ] + problems)
+
+            # Without the mapping of the company the base code is duplicated
+            Relation.delete(Relation.search([
+                        ('mapping', '=', mapping.id),
+                        ]))
+            Mapping.delete([mapping])
+            self.assertEqual(Mapping.get_integrity_problems([company]), [
+                    ('duplicated', company.id,
+                        [f.id for f in fallbacks[1:]], [base_code.id]),
+                    ])
+            self.assertEqual(
+                [p for p in Mapping.get_integrity_problems()
+                    if p[0] == 'duplicated'], [
+                    ('duplicated', None,
+                        [f.id for f in fallbacks[1:]], [base_code.id]),
+                    ])
+
+            Relation.delete(Relation.search([
+                        ('mapping', '=', fallbacks[0].id),
+                        ]))
+            self.assertIn(('empty', None, [fallbacks[0].id], []),
+                Mapping.get_integrity_problems([company]))
+
+            with self.assertRaises(UserError):
+                Mapping.write(fallbacks[1:2], {'template': None})
+
+    @with_transaction()
+    def test_period_ids(self):
+        'Test period ids of fiscal year'
+        pool = Pool()
+        Report = pool.get('aeat.303.report')
+        FiscalYear = pool.get('account.fiscalyear')
+        Period = pool.get('account.period')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            fiscalyear = get_fiscalyear(company)
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            periods = [p.id for p in fiscalyear.periods]
+
+            self.assertEqual(
+                Report.get_period_ids(fiscalyear, '1T'), periods[:3])
+            self.assertEqual(
+                Report.get_period_ids(fiscalyear, '02'), periods[1:2])
+            self.assertEqual(
+                Report.get_period_ids(fiscalyear, '4T'), periods[9:])
+
+            Period.delete([Period(periods[-1])])
+            self.assertEqual(
+                Report.get_period_ids(fiscalyear, '4T'), periods[9:11])
+            self.assertEqual(Report.get_period_ids(fiscalyear, '12'), [])
+
+    @with_transaction()
+    def test_mapping_compiled(self):
+        'Test compiled mapping is invalidated on changes'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Relation = pool.get('aeat.303.mapping-account.tax.code')
+
+        company = create_company(currency=create_currency('EUR'))
+        with set_company(company):
+            _, parent, tax_code, base_code = create_tax_codes(company)
+            mapping, = create_mapping(company, {
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+
+            codes, fixed = Mapping.get_compiled(company)
+            self.assertEqual(codes, {tax_code.id: 'accrued_vat_tax_3'})
+            self.assertEqual(fixed['accrued_vat_percent_3'], Decimal(21))
+
+            Mapping.write([mapping], {
+                    'code': [('add', [base_code.id])],
+                    })
+            codes, _ = Mapping.get_compiled(company)
+            self.assertEqual(codes, {
+                    tax_code.id: 'accrued_vat_tax_3',
+                    base_code.id: 'accrued_vat_tax_3',
+                    })
+
+            Relation.create([{
+                        'mapping': mapping.id,
+                        'code': parent.id,
+                        }])
+            codes, _ = Mapping.get_compiled(company)
+            self.assertIn(parent.id, codes)
+
+            Relation.delete(Relation.search([('mapping', '=', mapping.id)]))
+            codes, _ = Mapping.get_compiled(company)
+            self.assertEqual(codes, {})
+
+    @with_transaction()
+    def test_mapping_company(self):
+        'Test mappings are resolved by company'
+        pool = Pool()
+        Mapping = pool.get('aeat.303.mapping')
+        Field = pool.get('ir.model.field')
+
+        currency = create_currency('EUR')
+        company = create_company(currency=currency)
+        other = create_company(name='Other', currency=currency)
+        with set_company(company):
+            _, _, tax_code, base_code = create_tax_codes(company)
+            create_mapping(company, {
+                    'accrued_vat_tax_3': [tax_code],
+                    })
+        with set_company(other):
+            fiscalyear, _, other_tax, other_base = create_tax_codes(other)
+            create_mapping(other, {
+                    'accrued_vat_tax_3': [other_tax],
+                    })
+        field, = Field.search([
+                ('model.model', '=', 'aeat.303.report'),
+                ('name', '=', 'accrued_vat_percent_3'),
+                ])
+        Mapping.create([{
+                    'company': None,
+                    'type_': 'numeric',
+                    'aeat303_field': field.id,
+                    'number': Decimal('7'),
+                    }, {
+                    'company': None,
+                    'type_': 'numeric',
+                    'aeat303_field': Field.search([
+                            ('model.model', '=', 'aeat.303.report'),
+                            ('name', '=', 'special_prorate'),
+                            ])[0].id,
+                    'number': Decimal('1'),
+                    }])
+
+        codes, fixed = Mapping.get_compiled(company)
+        self.assertEqual(codes, {tax_code.id: 'accrued_vat_tax_3'})
+        self.assertEqual(fixed['accrued_vat_percent_3'], Decimal(21))
+        self.assertEqual(fixed['special_prorate'], Decimal(1))
+        codes, _ = Mapping.get_compiled(other)
+        self.assertEqual(codes, {other_tax.id: 'accrued_vat_tax_3'})
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()